@@ -2,3 +2,10 @@ __version__ = '24.12.8'
 
 from .aiaio import AIOFile, LineReader
 from .iocontext_mt import IOContextMT as IOContext
+from .iocontext_efd import IOContextEventFD
+from .iocontext_pool import IOContextPool
+from .iocontext_uring import IOContextUring
+from .iocontext_threads import IOContextThreadPool
+from .aio import set_backend
+from .cache import BlockCache
+from .iocontext_base import PRIO_LATENCY, PRIO_NORMAL, PRIO_BACKGROUND
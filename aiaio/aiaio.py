@@ -1,3 +1,6 @@
+import codecs
+import contextlib
+import os
 import errno
 import time
 import sys
@@ -43,73 +46,258 @@ class AIOFile:
     async def close(self):
         await self._file.release()
 
-    async def write(self, data, offset=0):
-        if self.encoding:
+    async def write(self, data, offset=0, priority=None, timeout=None):
+        if self.encoding and isinstance(data, str):
             data = data.encode(self.encoding)
-        return await self._file.write(data, offset=offset)
+        return await self._file.write(data, offset=offset, priority=priority, timeout=timeout)
 
-    async def read(self, n, offset=0):
-        data = await self._file.read(n, offset=offset)
+    async def read(self, n, offset=0, priority=None, timeout=None):
+        data = await self._file.read(n, offset=offset, priority=priority, timeout=timeout)
         if self.encoding:
             data = data.decode(self.encoding)
         return data
 
-    async def fsync(self, offset=0):
-        return await self._file.fsync()
+    async def readinto(self, buf, offset=0, priority=None, timeout=None):
+        return await self._file.readinto(buf, offset=offset, priority=priority, timeout=timeout)
+
+    async def stream(self, chunk_size=1 << 16, depth=4, start=0, end=None, recycle=False, priority=None):
+        # close the inner stream with this one, which returns its buffers
+        if not self.encoding or recycle:
+            async with contextlib.aclosing(self._file.stream(chunk_size, depth, start, end, recycle, priority)) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+            return
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        async with contextlib.aclosing(self._file.stream(chunk_size, depth, start, end, priority=priority)) as chunks:
+            async for chunk in chunks:
+                yield decoder.decode(chunk)
+        rest = decoder.decode(b'', final=True)
+        if rest:
+            yield rest
+
+    async def writev(self, buffers, offset=0, priority=None, timeout=None):
+        if self.encoding:
+            buffers = [data.encode(self.encoding) if isinstance(data, str) else data for data in buffers]
+        return await self._file.writev(buffers, offset=offset, priority=priority, timeout=timeout)
+
+    async def readv(self, buffers, offset=0, priority=None, timeout=None):
+        return await self._file.readv(buffers, offset=offset, priority=priority, timeout=timeout)
+
+    def writer(self, offset=None, bufsize=1 << 20, depth=4):
+        return AppendWriter(self, offset=offset, bufsize=bufsize, depth=depth)
+
+    async def fsync(self, offset=0, priority=None, timeout=None):
+        return await self._file.fsync(priority=priority, timeout=timeout)
+
+    async def fdsync(self, offset=0, priority=None, timeout=None):
+        return await self._file.fdsync(priority=priority, timeout=timeout)
 
-    async def fdsync(self, offset=0):
-        return await self._file.fdsync()
+    async def truncate(self, size=None):
+        return self._file.truncate(size)
 
-    async def truncate(self):
-        return self._file._file.truncate()
+
+class AppendWriter:
+    """Append records at the end offset, coalesced into large writes
+
+    At most depth writes of up to bufsize bytes are in flight. In direct
+    mode only whole blocks are written until the final flush.
+    """
+
+    def __init__(self, file, offset=None, bufsize=1 << 20, depth=4):
+        self._file = file
+        if offset is None:
+            offset = os.fstat(file.fileno()).st_size
+        self.offset = offset
+        self._bufsize = bufsize
+        self._depth = depth
+        self._alignment = file._file._alignment if file._file._direct else 1
+        self._buf = bytearray()
+        self._pending = set()
+
+    def __str__(self):
+        return f'AppendWriter({self._file}, offset={self.offset}, {len(self._buf)} buffered)'
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        try:
+            await self.drain()
+        finally:
+            if self._pending:
+                # a write failed, the others still complete before we return
+                await asyncio.wait(self._pending)
+                [t.exception() for t in self._pending if not t.cancelled()]
+                self._pending = set()
+
+    async def write(self, data):
+        if self._file.encoding and isinstance(data, str):
+            data = data.encode(self._file.encoding)
+        self._buf += data
+        if len(self._buf) >= self._bufsize:
+            await self._flush(len(self._buf) - len(self._buf) % self._alignment)
+        return len(data)
+
+    async def _wait(self, depth):
+        while len(self._pending) > depth:
+            done, self._pending = await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+            # retrieve all errors, then raise the first
+            errors = [ex for t in done if not t.cancelled() and (ex := t.exception()) is not None]
+            if errors:
+                raise errors[0]
+
+    async def _flush(self, n):
+        if n == 0:
+            return
+        await self._wait(self._depth - 1)
+        data = bytes(memoryview(self._buf)[0:n])
+        del self._buf[0:n]
+        self._pending.add(asyncio.ensure_future(self._file._file.write(data, offset=self.offset)))
+        self.offset += n
+
+    async def flush(self):
+        """Start writing all buffered data"""
+        await self._flush(len(self._buf))
+
+    async def drain(self):
+        """Write all buffered data and wait for all writes to complete"""
+        await self.flush()
+        await self._wait(0)
 
 
 class LineReader:
-    def __init__(self, file):
+    def __init__(self, file, chunksize=1 << 16, readahead=4):
         self._file = file
-        self._chunksize = 2048
-        self._chunk = None
-        self._choffs = 0
+        self._chunksize = chunksize
+        self._readahead = readahead
+        self._encoding = file.encoding
+        self._batches = None
+        self._lines = []
         self._offs = 0
-        self._lastLine = '' if file.encoding else b''
-        self._sep = '\n' if file.encoding else b'\n'
-        self._eof = False
 
     def __aiter__(self):
         return self
 
     async def __anext__(self):
-        while True:
-            if self._chunk is None:
-                if self._eof:
-                    raise StopAsyncIteration()
-                self._chunk = await self._file.read(self._chunksize, offset=self._choffs)
-                self._choffs += len(self._chunk)
-                if len(self._chunk) < self._chunksize:
-                    self._eof = True
-                self._lines = (self._lastLine + self._chunk).split(self._sep)
-                self._offs = 0
-            if self._offs < len(self._lines)-1:
-                self._offs += 1
-                return self._lines[self._offs-1] + self._sep
-            else:
-                self._lastLine = self._lines[-1]
-                self._chunk = None
-                if self._eof:
-                    return self._lastLine
+        while self._offs >= len(self._lines):
+            if self._batches is None:
+                self._batches = self.batches()
+            self._lines = await self._batches.__anext__()
+            self._offs = 0
+        self._offs += 1
+        return self._lines[self._offs-1]
+
+    def _decode(self, lines):
+        if self._encoding:
+            return [line.decode(self._encoding) for line in lines]
+        return lines
+
+    async def batches(self):
+        """Yield the lines of each chunk as a list, the last list holds the incomplete last line"""
+        sep = b'\n'
+        tail = b''
+        async for chunk in self._file._file.stream(self._chunksize, self._readahead):
+            lines = chunk.split(sep)
+            lines[0] = tail + lines[0]
+            tail = lines.pop()
+            if lines:
+                yield self._decode([line + sep for line in lines])
+        yield self._decode([tail])
+
+
+def parse_size(s):
+    units = dict(k=1 << 10, m=1 << 20, g=1 << 30)
+    s = s.lower().rstrip('b')
+    if s and s[-1] in units:
+        return int(s[:-1]) * units[s[-1]]
+    return int(s)
+
+
+class CopyStats:
+
+    def __init__(self):
+        self.nbytes = 0
+        self.requests = 0
+        self.t0 = time.time()
+
+    def add(self, nbytes, requests):
+        self.nbytes += nbytes
+        self.requests += requests
 
+    def __str__(self):
+        dt = max(time.time() - self.t0, 1e-9)
+        return (f'{self.nbytes} bytes in {dt:.3f} s, {self.nbytes / dt / 1e6:.1f} MB/s,'
+                f' {self.requests} requests, {self.requests / dt:.0f} IOPS')
+
+
+async def copy_aio(src, dst, size, dst_offset, blocksize, depth, stats):
+    """Copy with up to depth pipelined read/write pairs, reusing depth buffers"""
+    import mmap
+    buffers = [mmap.mmap(-1, blocksize) for i in range(depth)]
+    slots = asyncio.Semaphore(depth)
+
+    async def copy_block(offset):
+        buf = buffers.pop()
+        try:
+            mv = memoryview(buf)
+            n = await src.readinto(mv[0:min(blocksize, size - offset)], offset=offset)
+            await dst.write(mv[0:n], offset=dst_offset + offset)
+            stats.add(n, 2)
+        finally:
+            buffers.append(buf)
+            slots.release()
+
+    async with asyncio.TaskGroup() as tg:
+        for offset in range(0, size, blocksize):
+            await slots.acquire()
+            tg.create_task(copy_block(offset))
+
+
+async def copy_range(src, dst, size, dst_offset, blocksize, depth, stats):
+    """Copy with copy_file_range, in up to depth concurrent chunks of at least blocksize"""
+    loop = asyncio.get_running_loop()
+    chunk = max(blocksize, -(-size // depth))
+
+    def copy_chunk(offset, n):
+        ncopied, requests = 0, 0
+        while ncopied < n:
+            k = os.copy_file_range(src.fileno(), dst.fileno(), n - ncopied,
+                                   offset + ncopied, dst_offset + offset + ncopied)
+            requests += 1
+            if k == 0:
+                break
+            ncopied += k
+        return ncopied, requests
+
+    results = await asyncio.gather(*[loop.run_in_executor(None, copy_chunk, offset, min(chunk, size - offset))
+                                     for offset in range(0, size, chunk)])
+    [stats.add(*res) for res in results]
+
+
+async def cat(src, out, blocksize, depth, stats):
+    async for chunk in src.stream(blocksize, depth, recycle=not src.encoding):
+        out.write(chunk)
+        stats.add(len(chunk), 1)
+    out.flush()
 
 
 def mkparser(parser=None):
     from . import __version__
     import argparse
     if parser is None:
-        parser = argparse.ArgumentParser()
+        parser = argparse.ArgumentParser(description='Copy or concatenate files with asynchronous I/O')
 
-    parser.add_argument('input', metavar='file', type=str)
-    parser.add_argument('-o', '--output', metavar='file', type=str)
+    parser.add_argument('input', metavar='file', type=str, nargs='+')
+    parser.add_argument('-o', '--output', metavar='file', type=str,
+                        help='output file, default is to write to standard output')
     parser.add_argument('-a', '--append', action="store_true")
-    parser.add_argument('-e', '--encoding', metavar='S', type=str)
+    parser.add_argument('-e', '--encoding', metavar='S', type=str,
+                        help='decode the input when writing to standard output')
+    parser.add_argument('-b', '--block-size', metavar='N', type=parse_size, default=1 << 20)
+    parser.add_argument('-q', '--queue-depth', metavar='N', type=int, default=16)
+    parser.add_argument('-d', '--direct', action="store_true", help='use O_DIRECT')
+    parser.add_argument('--no-copy-range', action="store_true", help='do not use copy_file_range')
+    parser.add_argument('-s', '--stats', action="store_true", help='report throughput and IOPS')
 
     parser.add_argument('-V', '--version', action="version", version=f"%(prog)s v{__version__}")
     parser.add_argument('-v', '--verbose', type=int, metavar='N', nargs='?', const=1)
@@ -118,24 +306,55 @@ def mkparser(parser=None):
 
 
 async def arun(args=None):
-    import binascii
-    import os
+    import stat
+    from .aio import backends, auto_backend
     if args is None:
         parser = mkparser()
         args = parser.parse_args()
 
-    infile = args.input
-    outfile = args.output if args.output else args.input
-
-    async with AIOFile(infile, 'r+', numRequests=5001) as aio:
-        tasks = [aio.read(8, offset=i*8) for i in range(5000)]
-        reads = await asyncio.gather(*tasks)
-
-    lns = [len(r) for r in reads]
-
-    async with AIOFile(outfile, 'w+', numRequests=5001) as aio:
-        tasks = [aio.write(r, offset=sum(lns[0:i])) for i, r in enumerate(reads)]
-        writes = await asyncio.gather(*tasks)
+    blocksize, depth = args.block_size, args.queue_depth
+    stats = CopyStats()
+
+    if args.output is not None and os.path.exists(args.output):
+        # opening the output would truncate an input that is the same file
+        out = os.stat(args.output)
+        for infile in args.input:
+            st = os.stat(infile)
+            if (st.st_dev, st.st_ino) == (out.st_dev, out.st_ino):
+                raise ValueError(f'{infile} and {args.output} are the same file')
+
+    async with backends[auto_backend(args.direct)](2 * depth + 2, name='aiaio') as ioctx:
+        if args.output is None:
+            out = sys.stdout if args.encoding else sys.stdout.buffer
+            for infile in args.input:
+                async with AIOFile(infile, 'rb', encoding=args.encoding, io_context=ioctx, direct=args.direct) as src:
+                    await cat(src, out, blocksize, depth, stats)
+        else:
+            mode = 'rb+' if args.append and os.path.exists(args.output) else 'wb+'
+            async with AIOFile(args.output, mode, io_context=ioctx, direct=args.direct) as dst:
+                dst_offset = os.fstat(dst.fileno()).st_size if args.append else 0
+                use_range = (not args.direct and not args.no_copy_range
+                             and stat.S_ISREG(os.fstat(dst.fileno()).st_mode))
+                for infile in args.input:
+                    async with AIOFile(infile, 'rb', io_context=ioctx, direct=args.direct) as src:
+                        st = os.fstat(src.fileno())
+                        size = st.st_size
+                        if use_range and stat.S_ISREG(st.st_mode):
+                            try:
+                                await copy_range(src, dst, size, dst_offset, blocksize, depth, stats)
+                                dst_offset += size
+                                continue
+                            except OSError as ex:
+                                if ex.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                                    raise
+                                if args.verbose:
+                                    print(f'copy_file_range failed: {ex}, using aio', file=sys.stderr)
+                                use_range = False
+                        await copy_aio(src, dst, size, dst_offset, blocksize, depth, stats)
+                        dst_offset += size
+
+    if args.stats or args.verbose:
+        print(stats, file=sys.stderr)
 
 
 def run(args=None):
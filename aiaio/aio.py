@@ -1,45 +1,114 @@
+import os
 import time
 import sys
 import asyncio
+import functools
+from collections import deque
 
-from .iocontext_task import c_uint8, IOCB
 from .iocontext_task import IO_CMD_PREAD, IO_CMD_PWRITE, IO_CMD_FSYNC, IO_CMD_FDSYNC
+from .iocontext_task import IO_CMD_PREADV, IO_CMD_PWRITEV
 
-from .iocontext_mt import IOContextMT as IOContext, global_context_mt as global_context, global_contexts_mt as global_contexts
+from .buffers import PinnedBuffer, PinnedIOVec, global_buffer_pool
+from .iocontext_task import libaio
+from .iocontext_mt import IOContextMT as IOContext, global_context_mt, global_contexts_mt as global_contexts
+from .iocontext_efd import IOContextEventFD
+from .iocontext_uring import IOContextUring
+from .iocontext_threads import IOContextThreadPool
 
 
 global_t0 = time.time()
 
 
+def open_direct(path, flags):
+    return os.open(path, flags | os.O_DIRECT)
+
+
+backends = {
+    'libaio': IOContext,
+    'libaio-efd': IOContextEventFD,
+    'uring': IOContextUring,
+    'threads': IOContextThreadPool,
+}
+
+# set by set_backend, None selects a global context per file
+global_context = None
+global_context_threads = IOContextThreadPool(1000, name='global-threads')
+global_contexts.append(global_context_threads)
+
+
 async def release_globals():
     for i, gctx in enumerate(global_contexts):
         await gctx.release()
 
 
+def auto_backend(direct):
+    """libaio is only asynchronous with O_DIRECT, buffered files use the thread pool"""
+    return 'libaio' if direct and libaio is not None else 'threads'
+
+
+def default_context(direct):
+    if global_context is not None:
+        return global_context
+    if auto_backend(direct) == 'libaio':
+        return global_context_mt
+    return global_context_threads
+
+
+def set_backend(backend, numRequests=1000, **kw):
+    """Use a new context of the named backend for AIO objects without io_context
+
+    With 'auto' the backend is again chosen per file.
+    """
+    global global_context
+    if backend == 'auto':
+        global_context = None
+        return None
+    global_context = backends[backend](numRequests, name=f'global-{backend}', **kw)
+    global_contexts.append(global_context)
+    return global_context
+
+
 class AIO:
     _file = None
     _fname = None
     _mode = None
     _verbose = 0
+    _direct = False
+    _size = 0
+    # largest read copied inline on the loop thread from the page cache
+    _nowaitMax = 1 << 20
     ctx = None
+    cache = None
+    # (st_dev, st_ino) of the file, the key of its blocks in the cache
+    _key = None
 
-    def __init__(self, fname, mode, numRequests=10000, io_context=None, **kw):
-        global global_context, global_contexts
+    def __init__(self, fname, mode, numRequests=None, io_context=None,
+                 direct=False, buffer_pool=None, priority=None, nowait=True, cache=None, **kw):
         self._fname = fname
+        self.priority = priority
+        # O_DIRECT reads bypass the page cache and would wait for the device
+        self._nowait = nowait and not direct and hasattr(os, 'RWF_NOWAIT')
         self._mode = mode
         self._opts = kw
+        self._direct = direct
+        self._rmw_lock = asyncio.Lock()
         if io_context is not None:
             self.ctx = io_context
         else:
-            if numRequests > global_context.numRequests:
-                global_context = IOContext(numRequests)
-                global_contexts += [global_context]
-                #self.log(f'AIO: new context: {len(global_contexts)} now')
-            self.ctx = global_context
+            # requests beyond the capacity of the global context wait for
+            # admission, numRequests is accepted for compatibility only
+            self.ctx = default_context(direct)
+        if buffer_pool is None:
+            buffer_pool = getattr(self.ctx, 'buffers', None) or global_buffer_pool
+        self._pool = buffer_pool
+        self._alignment = self._pool.alignment
+        if cache is None:
+            cache = getattr(self.ctx, 'cache', None)
+        # cache=False disables the cache of the context for this file
+        self.cache = cache or None
 
     def __del__(self):
-        if self._file:
-            self._file.close()
+        self._close()
 
     def __str__(self):
         return f'AIO(fd={self.fileno()}, {self._fname}, {self._mode}, {self.ctx})'
@@ -48,74 +117,369 @@ class AIO:
         print(f'{time.time() - global_t0: 12.3f} {self} {msg}')
         sys.stdout.flush()
 
-    def _read(self, n, offset=0):
-        indata = (c_uint8 * n)()
-        cb = IOCB()
-        cb.aio_fildes = self._file.fileno()
-        # cb.aio_lio_opcode = IO_CMD_PREAD == 0
-        cb.uc.buf = indata
-        cb.uc.nbytes = n
-        cb.uc.offset = offset
-        return self.ctx._io_submit(cb)
-
-    async def read(self, n, offset=0):
-        cb = self._read(n, offset=offset)
-        data = None
-        async with cb['cond']:
-            await cb['cond'].wait()
-            nread = cb['code']
-            data = bytes(cb['cb'].uc.buf[0:nread])
-        return data
-
-    def _write(self, data, offset=0):
-        n = len(data)
-        indata = (c_uint8 * n)()
-        indata[0:n] = data
-        cb = IOCB()
-        cb.aio_fildes = self._file.fileno()
-        cb.aio_lio_opcode = IO_CMD_PWRITE
-        cb.uc.buf = indata
-        cb.uc.nbytes = n
-        cb.uc.offset = offset
-        return self.ctx._io_submit(cb)
-
-    async def write(self, data, offset=0):
-        cb = self._write(data, offset=offset)
-        async with cb['cond']:
-            await cb['cond'].wait()
-        return cb['code']
-
-    def _fsync(self, op):
-        cb = IOCB()
-        cb.aio_fildes = self._file.fileno()
-        cb.aio_lio_opcode = op
-        return self.ctx._io_submit(cb)
-
-    async def fsync(self):
-        cb = self._fsync(IO_CMD_FSYNC)
-        async with cb['cond']:
-            await cb['cond'].wait()
-        return cb['code']
-
-    async def fdsync(self):
-        cb = self._fsync(IO_CMD_FDSYNC)
-        async with cb['cond']:
-            await cb['cond'].wait()
-        return cb['code']
+    def _prio(self, priority):
+        return self.priority if priority is None else priority
+
+    def _submit_rw(self, op, pinned, offset, prio=None):
+        return self.ctx._io_submit(op, self._file.fileno(), pinned.address, pinned.nbytes, offset, pinned, prio)
+
+    def _submit_rwv(self, op, iov, offset, prio=None):
+        return self.ctx._io_submit(op, self._file.fileno(), iov.address, iov.count, offset, iov, prio)
+
+    def _readinto(self, buf, offset=0, prio=None):
+        return self._submit_rw(IO_CMD_PREAD, PinnedBuffer(buf, writable=True), offset, prio)
+
+    def _write(self, data, offset=0, prio=None):
+        return self._submit_rw(IO_CMD_PWRITE, PinnedBuffer(data), offset, prio)
+
+    def _aligned_span(self, offset, n):
+        a = self._alignment
+        return offset - offset % a, -(-(offset + n) // a) * a
+
+    def _is_aligned(self, pinned, offset):
+        return (pinned.address | pinned.nbytes | offset) % self._alignment == 0
+
+    def _is_aligned_v(self, iov, offset):
+        return all(self._is_aligned(p, offset) for p in iov.buffers())
+
+    async def _alloc_read(self, make, n, offset, prio=None):
+        # read n bytes into a buffer made by make() once the request is
+        # admitted, so that reads waiting in the backlog hold no memory
+        made = []
+
+        def alloc():
+            made.append(make())
+            return PinnedBuffer(memoryview(made[0])[0:n], writable=True)
+
+        try:
+            nread = await self.ctx._io_submit(IO_CMD_PREAD, self._file.fileno(), 0, n, offset, prio=prio, alloc=alloc)
+        except OSError:
+            if made and self._direct:
+                self._pool.put(made[0])
+            raise
+        return made[0], nread
+
+    async def _direct_read_span(self, offset, n, prio=None):
+        # read the aligned blocks covering [offset, offset+n) into a pool buffer
+        start, end = self._aligned_span(offset, n)
+        tmp, nread = await self._alloc_read(lambda: self._pool.get(end - start), end - start, start, prio)
+        lo = offset - start
+        return tmp, lo, max(0, min(nread - lo, n))
+
+    async def _direct_readinto(self, buf, offset, prio=None):
+        pinned = PinnedBuffer(buf, writable=True)
+        if self._is_aligned(pinned, offset):
+            return await self._submit_rw(IO_CMD_PREAD, pinned, offset, prio)
+        n = pinned.nbytes
+        pinned.release()
+        if n == 0:
+            return 0
+        tmp, lo, nread = await self._direct_read_span(offset, n, prio)
+        memoryview(buf).cast('B')[0:nread] = memoryview(tmp)[lo:lo + nread]
+        self._pool.put(tmp)
+        return nread
+
+    async def _direct_write(self, data, offset, prio=None):
+        pinned = PinnedBuffer(data)
+        n = pinned.nbytes
+        self._size = max(self._size, offset + n)
+        if self._is_aligned(pinned, offset):
+            return await self._submit_rw(IO_CMD_PWRITE, pinned, offset, prio)
+        pinned.release()
+        if n == 0:
+            return 0
+        if (offset | n) % self._alignment == 0:
+            # only the buffer address is unaligned: bounce without reading
+            tmp = self._pool.get(n)
+            mv = memoryview(tmp)
+            mv[0:n] = memoryview(data).cast('B')
+            nwritten = await self._write(mv[0:n], offset, prio)
+            self._pool.put(tmp)
+            return nwritten
+        # read-modify-write of the partial head and tail blocks; serialized,
+        # since concurrent writers may share these blocks
+        async with self._rmw_lock:
+            a = self._alignment
+            start, end = self._aligned_span(offset, n)
+            tmp = self._pool.get(end - start)
+            mv = memoryview(tmp)
+            blocks = []
+            if offset != start:
+                blocks.append(start)
+            if offset + n != end and end - a not in blocks:
+                blocks.append(end - a)
+            nreads = await asyncio.gather(*[self._readinto(mv[b - start:b - start + a], b, prio) for b in blocks])
+            for b, nread in zip(blocks, nreads):
+                mv[b - start + nread:b - start + a] = bytes(a - nread)
+            lo = offset - start
+            mv[lo:lo + n] = memoryview(data).cast('B')
+            nwritten = await self._write(mv[0:end - start], start, prio)
+            if end > self._size:
+                # drop the padding of the last block
+                os.ftruncate(self._file.fileno(), self._size)
+            self._pool.put(tmp)
+        return max(0, min(nwritten - lo, n))
+
+    def _nowait_readinto(self, mv, offset):
+        # read from the page cache without blocking, None if not cached
+        fd = self._file.fileno()
+        if len(mv) > self._nowaitMax or not self.ctx.nowait_ok(fd, offset, len(mv)):
+            return None
+        try:
+            n = os.preadv(fd, [mv], offset, os.RWF_NOWAIT)
+        except BlockingIOError:
+            self.ctx.note_nowait(fd, False)
+            return None
+        except OSError:
+            # not supported by this file, errors are reported by the async read
+            self._nowait = False
+            return None
+        self.ctx.note_nowait(fd, True)
+        return n
+
+    async def _buffered_readinto(self, buf, offset, prio):
+        if not self._nowait:
+            return await self._readinto(buf, offset, prio)
+        mv = memoryview(buf).cast('B')
+        n = self._nowait_readinto(mv, offset)
+        if n is None:
+            return await self._readinto(buf, offset, prio)
+        return n + await self._nowait_rest(mv, n, offset, prio)
+
+    async def _nowait_rest(self, mv, n, offset, prio):
+        # read the rest of mv after n bytes from the page cache, if not at the end of file
+        if n == 0 or n == len(mv) or offset + n >= os.fstat(self._file.fileno()).st_size:
+            return 0
+        return await self._readinto(mv[n:], offset + n, prio)
+
+    async def _file_readinto(self, buf, offset, prio):
+        # read from the file, bypassing the block cache
+        if self._direct:
+            return await self._direct_readinto(buf, offset, prio)
+        return await self._buffered_readinto(buf, offset, prio)
+
+    async def _file_read(self, n, offset, prio):
+        if self._direct:
+            if n == 0:
+                return b''
+            tmp, lo, nread = await self._direct_read_span(offset, n, prio)
+            data = bytes(memoryview(tmp)[lo:lo + nread])
+            self._pool.put(tmp)
+            return data
+        if self._nowait and n <= self._nowaitMax:
+            mv = memoryview(bytearray(n))
+            nread = self._nowait_readinto(mv, offset)
+            if nread is not None:
+                nread += await self._nowait_rest(mv, nread, offset, prio)
+                return bytes(mv[0:nread])
+        data, nread = await self._alloc_read(lambda: bytearray(n), n, offset, prio)
+        return bytes(memoryview(data)[0:nread])
+
+    def _cached_span(self, offset, n):
+        # whether a read goes through the block cache
+        bs = self.cache.blockSize
+        return n > 0 and (offset + n - 1) // bs - offset // bs < self.cache.maxBlocks
+
+    async def _block_readinto(self, buf, offset, prio):
+        # copy from the cached blocks covering the range, reading the missing ones
+        cache = self.cache
+        mv = memoryview(buf).cast('B')
+        n = len(mv)
+        bs = cache.blockSize
+        first, last = offset // bs, (offset + n - 1) // bs
+        if not self._cached_span(offset, n):
+            return await self._file_readinto(buf, offset, prio)
+        keys = [(*self._key, index) for index in range(first, last + 1)]
+        blocks = [cache.lookup(key) for key in keys]
+        missing = [i for i, data in enumerate(blocks) if data is None]
+        if missing:
+            fetched = await asyncio.gather(*[cache.fetch(keys[i], functools.partial(
+                self._file_read, bs, (first + i) * bs, prio)) for i in missing])
+            for i, data in zip(missing, fetched):
+                blocks[i] = data
+        pos = 0
+        lo = offset - first * bs
+        for data in blocks:
+            k = min(len(data) - lo, n - pos)
+            if k <= 0:
+                break
+            mv[pos:pos + k] = data[lo:lo + k]
+            pos += k
+            if len(data) < bs:
+                # end of file
+                break
+            lo = 0
+        return pos
+
+    async def _invalidating(self, aw, offset, nbytes):
+        # drop the overlapping blocks before and after the write, so that
+        # no read racing with it caches the old data
+        self.cache.invalidate(self._key, offset, nbytes)
+        try:
+            return await aw
+        finally:
+            self.cache.invalidate(self._key, offset, nbytes)
+
+    async def readinto(self, buf, offset=0, priority=None, timeout=None):
+        if timeout is not None:
+            return await asyncio.wait_for(self.readinto(buf, offset, priority), timeout)
+        if self.cache is not None:
+            return await self._block_readinto(buf, offset, self._prio(priority))
+        return await self._file_readinto(buf, offset, self._prio(priority))
+
+    async def read(self, n, offset=0, priority=None, timeout=None):
+        if timeout is not None:
+            return await asyncio.wait_for(self.read(n, offset, priority), timeout)
+        if self.cache is not None and self._cached_span(offset, n):
+            data = bytearray(n)
+            nread = await self._block_readinto(data, offset, self._prio(priority))
+            return bytes(memoryview(data)[0:nread])
+        return await self._file_read(n, offset, self._prio(priority))
+
+    async def write(self, data, offset=0, priority=None, timeout=None):
+        if timeout is not None:
+            return await asyncio.wait_for(self.write(data, offset, priority), timeout)
+        prio = self._prio(priority)
+        aw = self._direct_write(data, offset, prio) if self._direct else self._write(data, offset, prio)
+        if self.cache is not None:
+            return await self._invalidating(aw, offset, memoryview(data).nbytes)
+        return await aw
+
+    async def stream(self, chunk_size=1 << 16, depth=4, start=0, end=None, recycle=False, priority=None):
+        """Read [start, end) in chunks, keeping up to depth reads in flight
+
+        With recycle, chunks are memoryviews into depth reused buffers that
+        are valid until the next chunk is requested. Streams bypass the block
+        cache, so that scans do not evict the hot blocks.
+        """
+        prio = self._prio(priority)
+        # pool buffers go back to the pool at the end, so their reads are
+        # awaited instead of cancelled: the kernel may still write to them
+        pooled = recycle and self._direct
+        if recycle:
+            bufs = [self._pool.get(chunk_size) if self._direct else bytearray(chunk_size) for i in range(depth)]
+            free = list(range(depth))
+            reads = [None] * depth
+        pending = deque()
+        offset = start
+        eof = False
+        try:
+            while True:
+                while not eof and len(pending) < depth and (end is None or offset < end):
+                    n = chunk_size if end is None else min(chunk_size, end - offset)
+                    if recycle:
+                        i = free.pop()
+                        fut = reads[i] = asyncio.ensure_future(
+                            self._file_readinto(memoryview(bufs[i])[0:n], offset, prio))
+                    else:
+                        i = None
+                        fut = asyncio.ensure_future(self._file_read(n, offset, prio))
+                    pending.append((i, n, fut))
+                    offset += n
+                if not pending:
+                    break
+                i, n, fut = pending.popleft()
+                res = await fut
+                nread = res if recycle else len(res)
+                if nread < n:
+                    # short read: end of file
+                    eof = True
+                    if not pooled:
+                        [fut.cancel() for k, m, fut in pending]
+                    pending.clear()
+                if nread > 0:
+                    yield memoryview(bufs[i])[0:nread] if recycle else res
+                if recycle:
+                    free.append(i)
+        finally:
+            if not pooled:
+                [fut.cancel() for k, m, fut in pending]
+            else:
+                await asyncio.gather(*[fut for fut in reads if fut is not None], return_exceptions=True)
+                # the buffers of reads cancelled with the stream are left to the
+                # garbage collector, their requests still hold them
+                [self._pool.put(buf) for buf, fut in zip(bufs, reads) if fut is None or not fut.cancelled()]
+
+    async def readv(self, buffers, offset=0, priority=None, timeout=None):
+        if timeout is not None:
+            return await asyncio.wait_for(self.readv(buffers, offset, priority), timeout)
+        iov = PinnedIOVec(buffers, writable=True)
+        if not self._direct or self._is_aligned_v(iov, offset):
+            return await self._submit_rwv(IO_CMD_PREADV, iov, offset, self._prio(priority))
+        n = iov.nbytes
+        iov.release()
+        if n == 0:
+            return 0
+        tmp, lo, nread = await self._direct_read_span(offset, n, self._prio(priority))
+        src = memoryview(tmp)[lo:lo + nread]
+        for buf in buffers:
+            dst = memoryview(buf).cast('B')
+            k = min(len(dst), len(src))
+            dst[0:k] = src[0:k]
+            src = src[k:]
+        self._pool.put(tmp)
+        return nread
+
+    async def writev(self, buffers, offset=0, priority=None, timeout=None):
+        if timeout is not None:
+            return await asyncio.wait_for(self.writev(buffers, offset, priority), timeout)
+        iov = PinnedIOVec(buffers)
+        prio = self._prio(priority)
+        if not self._direct or self._is_aligned_v(iov, offset):
+            aw = self._submit_rwv(IO_CMD_PWRITEV, iov, offset, prio)
+        else:
+            iov.release()
+            aw = self._direct_write(b''.join(buffers), offset, prio)
+        if self.cache is not None:
+            return await self._invalidating(aw, offset, iov.nbytes)
+        return await aw
+
+    def _fsync(self, op, prio=None):
+        return self.ctx._io_submit(op, self._file.fileno(), prio=prio)
+
+    async def fsync(self, priority=None, timeout=None):
+        cb = self._fsync(IO_CMD_FSYNC, self._prio(priority))
+        return await (cb if timeout is None else asyncio.wait_for(cb, timeout))
+
+    async def fdsync(self, priority=None, timeout=None):
+        cb = self._fsync(IO_CMD_FDSYNC, self._prio(priority))
+        return await (cb if timeout is None else asyncio.wait_for(cb, timeout))
 
     def fileno(self):
         return self._file.fileno() if self._file and not self._file.closed else -1
 
+    def truncate(self, size=None):
+        size = self._file.truncate(size)
+        self._size = size
+        if self.cache is not None:
+            self.cache.invalidate_file(self._key)
+        return size
+
     async def start(self):
         await self.ctx.start()
         if self._file is None:
-            self._file = open(self._fname, self._mode)
-
-    async def release(self):
+            if self._direct:
+                self._file = open(self._fname, self._mode, opener=open_direct)
+                self._size = os.fstat(self._file.fileno()).st_size
+            else:
+                self._file = open(self._fname, self._mode)
+            st = os.fstat(self._file.fileno())
+            self._key = (st.st_dev, st.st_ino)
+            if self.cache is not None:
+                self.cache.attach(self._key, truncate='w' in self._mode)
+
+    def _close(self):
         if self._file:
+            if not self._file.closed:
+                self.ctx.file_closed(self._file.fileno())
             self._file.close()
+            if self.cache is not None:
+                self.cache.detach(self._key)
         self._file = None
 
+    async def release(self):
+        self._close()
+
 
 def mkparser(parser=None):
     import argparse
@@ -140,7 +504,7 @@ async def arun(args=None):
         parser = mkparser()
         args = parser.parse_args()
 
-    aio = AIO('example.txt', 'r+', numRequests=15000)
+    aio = AIO('example.txt', 'r+')
     await aio.start()
     res = await aio.read(28, offset=0)
     print(res)
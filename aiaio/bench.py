@@ -0,0 +1,283 @@
+import os
+import sys
+import time
+import json
+import mmap
+import random
+import asyncio
+import functools
+import concurrent.futures
+
+from .aiaio import AIOFile, parse_size
+from .iocontext_task import IOContext as IOContextTask
+from .iocontext_mt import IOContextMT
+from .iocontext_efd import IOContextEventFD
+from .iocontext_uring import IOContextUring
+from .iocontext_threads import IOContextThreadPool
+from .cache import BlockCache
+
+
+contexts = {
+    'aio': IOContextMT,
+    'aio-task': IOContextTask,
+    'aio-submit': functools.partial(IOContextMT, submitThread=True),
+    'aio-poll': functools.partial(IOContextMT, pollWindow=50e-6),
+    'aio-efd': IOContextEventFD,
+    'uring': IOContextUring,
+    'aio-threads': IOContextThreadPool,
+    # a new cache per run, so that runs do not share warm blocks
+    'aio-cache': lambda *args, **kw: IOContextMT(*args, cache=BlockCache(), **kw),
+}
+
+engines = list(contexts) + ['sync', 'threads']
+
+workloads = ['read', 'write', 'randread', 'randwrite', 'randrw']
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Job:
+    """One benchmark run: a workload at a given block size and queue depth"""
+
+    def __init__(self, engine, rw, bs, qd, size, requests, mix=0.5, direct=False):
+        self.engine = engine
+        self.rw = rw
+        self.bs = bs
+        self.qd = 1 if engine == 'sync' else qd
+        self.size = size
+        self.requests = requests
+        self.mix = mix
+        self.direct = direct
+        self.latencies = []
+        self._next = 0
+        self._nblocks = max(size // bs, 1)
+        self._random = random.Random(0)
+
+    def __str__(self):
+        return f'{self.engine:8s} {self.rw:9s} bs={self.bs:<8d} qd={self.qd:<4d}'
+
+    def next_request(self):
+        """Return (is_write, offset) of the next request or None when done"""
+        if self._next >= self.requests:
+            return None
+        i = self._next
+        self._next += 1
+        if self.rw.startswith('rand'):
+            offset = self._random.randrange(self._nblocks) * self.bs
+        else:
+            offset = (i % self._nblocks) * self.bs
+        if self.rw.endswith('rw'):
+            write = self._random.random() >= self.mix
+        else:
+            write = self.rw.endswith('write')
+        return write, offset
+
+    def buffer(self):
+        buf = mmap.mmap(-1, self.bs)
+        buf.write(os.urandom(self.bs))
+        return buf
+
+    def result(self, seconds, cpu):
+        lat = sorted(self.latencies)
+        n = len(lat)
+        return dict(
+            engine=self.engine, rw=self.rw, bs=self.bs, qd=self.qd, direct=self.direct,
+            requests=n, seconds=seconds, cpu=cpu,
+            iops=n / seconds, mbps=n * self.bs / seconds / 1e6,
+            lat_us=dict(
+                mean=sum(lat) / n * 1e6 if n else 0,
+                p50=percentile(lat, 50) * 1e6,
+                p90=percentile(lat, 90) * 1e6,
+                p99=percentile(lat, 99) * 1e6,
+                p999=percentile(lat, 99.9) * 1e6,
+            ))
+
+
+def open_flags(direct):
+    return os.O_RDWR | (os.O_DIRECT if direct else 0)
+
+
+async def run_aio(job, fname):
+    async with contexts[job.engine](2 * job.qd + 2, name=f'bench-{job.engine}') as ioctx:
+        async with AIOFile(fname, 'rb+', io_context=ioctx, direct=job.direct) as aio:
+
+            async def worker():
+                buf = job.buffer()
+                while (req := job.next_request()) is not None:
+                    write, offset = req
+                    t0 = time.perf_counter()
+                    if write:
+                        await aio.write(buf, offset=offset)
+                    else:
+                        await aio.readinto(buf, offset=offset)
+                    job.latencies.append(time.perf_counter() - t0)
+
+            await asyncio.gather(*[worker() for i in range(job.qd)])
+
+
+async def run_sync(job, fname):
+    fd = os.open(fname, open_flags(job.direct))
+    try:
+        buf = job.buffer()
+        while (req := job.next_request()) is not None:
+            write, offset = req
+            t0 = time.perf_counter()
+            if write:
+                os.pwritev(fd, [buf], offset)
+            else:
+                os.preadv(fd, [buf], offset)
+            job.latencies.append(time.perf_counter() - t0)
+    finally:
+        os.close(fd)
+
+
+async def run_threads(job, fname):
+    loop = asyncio.get_running_loop()
+    fd = os.open(fname, open_flags(job.direct))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(job.qd) as executor:
+
+            async def worker():
+                buf = job.buffer()
+                while (req := job.next_request()) is not None:
+                    write, offset = req
+                    t0 = time.perf_counter()
+                    if write:
+                        await loop.run_in_executor(executor, os.pwritev, fd, [buf], offset)
+                    else:
+                        await loop.run_in_executor(executor, os.preadv, fd, [buf], offset)
+                    job.latencies.append(time.perf_counter() - t0)
+
+            await asyncio.gather(*[worker() for i in range(job.qd)])
+    finally:
+        os.close(fd)
+
+
+runners = dict(sync=run_sync, threads=run_threads)
+
+
+async def run_job(job, fname):
+    runner = runners.get(job.engine, run_aio)
+    t0, c0 = time.perf_counter(), time.process_time()
+    await runner(job, fname)
+    return job.result(time.perf_counter() - t0, time.process_time() - c0)
+
+
+def prepare_file(fname, size, force=False):
+    """Fill fname with size random bytes unless large enough, return whether it was created
+
+    An existing file is only overwritten with force.
+    """
+    exists = os.path.exists(fname)
+    if exists:
+        if os.path.getsize(fname) >= size:
+            return False
+        if not force:
+            raise ValueError(f'{fname} exists and is smaller than {size} bytes, use --force to overwrite it')
+    chunk = os.urandom(1 << 20)
+    with open(fname, 'wb') as f:
+        for offset in range(0, size, len(chunk)):
+            f.write(chunk[0:min(len(chunk), size - offset)])
+    return not exists
+
+
+async def available(engine):
+    """Whether the context of engine can be set up here"""
+    if engine not in contexts:
+        return True
+    try:
+        async with contexts[engine](2, name=f'probe-{engine}'):
+            return True
+    except OSError as ex:
+        print(f'skipping engine {engine}: {ex}', file=sys.stderr)
+        return False
+
+
+def mkparser(parser=None):
+    from . import __version__
+    import argparse
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Benchmark aiaio against blocking and thread pool I/O')
+
+    def csv(type):
+        return lambda s: [type(v) for v in s.split(',')]
+
+    parser.add_argument('-f', '--file', metavar='file', type=str, default='aiaio-bench.dat')
+    parser.add_argument('-S', '--size', metavar='N', type=parse_size, default=64 << 20)
+    parser.add_argument('-w', '--rw', metavar='W,..', type=csv(str), default=['read', 'randread'],
+                        help=f'workloads: {", ".join(workloads)}')
+    parser.add_argument('-b', '--bs', metavar='N,..', type=csv(parse_size), default=[4096])
+    parser.add_argument('-q', '--qd', metavar='N,..', type=csv(int), default=[1, 32])
+    parser.add_argument('-E', '--engine', metavar='E,..', type=csv(str), default=engines,
+                        help=f'engines: {", ".join(engines)}, default all available')
+    parser.add_argument('-n', '--requests', metavar='N', type=int, default=10000)
+    parser.add_argument('-m', '--mix', metavar='F', type=float, default=0.5,
+                        help='fraction of reads in randrw')
+    parser.add_argument('-d', '--direct', action="store_true", help='use O_DIRECT')
+    parser.add_argument('-j', '--json', metavar='file', type=str, help='write the results as JSON, - for stdout')
+    parser.add_argument('-k', '--keep', action="store_true", help='keep the test file')
+    parser.add_argument('-F', '--force', action="store_true",
+                        help='allow writing into an existing file, which is never deleted')
+
+    parser.add_argument('-V', '--version', action="version", version=f"%(prog)s v{__version__}")
+    parser.add_argument('-v', '--verbose', type=int, metavar='N', nargs='?', const=1)
+
+    return parser
+
+
+async def arun(args=None):
+    from . import __version__
+    if args is None:
+        parser = mkparser()
+        args = parser.parse_args()
+
+    for rw in args.rw:
+        if rw not in workloads:
+            raise ValueError(f'unknown workload: {rw}')
+    for engine in args.engine:
+        if engine not in engines:
+            raise ValueError(f'unknown engine: {engine}')
+    if os.path.exists(args.file) and not args.force and any('write' in rw or rw.endswith('rw') for rw in args.rw):
+        raise ValueError(f'{args.file} exists, use --force to write into it')
+    selected = [engine for engine in args.engine if await available(engine)]
+
+    created = prepare_file(args.file, args.size, args.force)
+    results = []
+    try:
+        for rw in args.rw:
+            for bs in args.bs:
+                for qd in args.qd:
+                    for engine in selected:
+                        if engine == 'sync' and qd != args.qd[0]:
+                            continue
+                        job = Job(engine, rw, bs, qd, args.size, args.requests, args.mix, args.direct)
+                        res = await run_job(job, args.file)
+                        results.append(res)
+                        lat = res['lat_us']
+                        print(f'{job} {res["iops"]:10.0f} IOPS {res["mbps"]:9.1f} MB/s cpu {res["cpu"]:6.3f} s'
+                              f' lat p50 {lat["p50"]:8.1f} p99 {lat["p99"]:8.1f} p99.9 {lat["p999"]:8.1f} us',
+                              file=sys.stderr if args.json == '-' else sys.stdout)
+    finally:
+        if created and not args.keep:
+            os.unlink(args.file)
+
+    if args.json:
+        report = dict(version=__version__, time=time.time(), size=args.size, results=results)
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=1)
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=1)
+    return results
+
+
+def run(args=None):
+    asyncio.run(arun(args))
+
+
+if __name__ == "__main__":
+    run()
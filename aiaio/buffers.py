@@ -0,0 +1,124 @@
+import mmap
+
+from ctypes import c_int, c_size_t, c_ssize_t, c_void_p, c_char_p, py_object
+from ctypes import pythonapi, addressof, byref, POINTER, Structure
+
+
+PyBUF_SIMPLE = 0
+PyBUF_WRITABLE = 1
+
+
+class PY_BUFFER(Structure):
+    _fields_ = [
+        ("buf", c_void_p),
+        ("obj", c_void_p),
+        ("len", c_ssize_t),
+        ("itemsize", c_ssize_t),
+        ("readonly", c_int),
+        ("ndim", c_int),
+        ("format", c_char_p),
+        ("shape", c_void_p),
+        ("strides", c_void_p),
+        ("suboffsets", c_void_p),
+        ("internal", c_void_p),
+        ]
+
+
+class IOVEC(Structure):
+    _fields_ = [
+        ("iov_base", c_void_p),
+        ("iov_len", c_size_t),
+        ]
+
+
+PY_BUFFERp = POINTER(PY_BUFFER)
+
+pythonapi.PyObject_GetBuffer.argtypes = [py_object, PY_BUFFERp, c_int]
+pythonapi.PyObject_GetBuffer.restype = c_int
+
+pythonapi.PyBuffer_Release.argtypes = [PY_BUFFERp]
+pythonapi.PyBuffer_Release.restype = None
+
+
+class PinnedBuffer:
+    """Export of a contiguous buffer, holding the memory in place until released"""
+    __slots__ = ('_view', 'address', 'nbytes')
+
+    def __init__(self, obj, writable=False):
+        self._view = None
+        view = PY_BUFFER()
+        pythonapi.PyObject_GetBuffer(obj, byref(view), PyBUF_WRITABLE if writable else PyBUF_SIMPLE)
+        self._view = view
+        self.address = self._view.buf or 0
+        self.nbytes = self._view.len
+
+    def __del__(self):
+        self.release()
+
+    def release(self):
+        if self._view is not None:
+            pythonapi.PyBuffer_Release(byref(self._view))
+            self._view = None
+
+
+class PinnedIOVec:
+    """Pinned exports of a sequence of buffers and the iovec array describing them"""
+    __slots__ = ('_pinned', 'iov', 'address', 'count', 'nbytes')
+
+    def __init__(self, objs, writable=False):
+        self._pinned = [PinnedBuffer(obj, writable=writable) for obj in objs]
+        self.count = len(self._pinned)
+        self.iov = (IOVEC * self.count)(*[(p.address, p.nbytes) for p in self._pinned])
+        self.address = addressof(self.iov)
+        self.nbytes = sum(p.nbytes for p in self._pinned)
+
+    def buffers(self):
+        return self._pinned
+
+    def release(self):
+        [p.release() for p in self._pinned]
+        self._pinned = []
+
+
+class AlignedBufferPool:
+    """Free lists of mmap-backed, page aligned buffers in power of two size classes"""
+
+    def __init__(self, alignment=4096, maxFree=64):
+        if alignment & (alignment - 1) or alignment > mmap.PAGESIZE:
+            raise ValueError(f'alignment must be a power of two <= {mmap.PAGESIZE}: {alignment}')
+        self.alignment = alignment
+        self.maxFree = maxFree
+        self._free = {}
+
+    def __str__(self):
+        return f'AlignedBufferPool(a={self.alignment}, {sum(len(f) for f in self._free.values())} free)'
+
+    def sizeclass(self, nbytes):
+        return max(1 << (nbytes - 1).bit_length(), self.alignment)
+
+    def get(self, nbytes):
+        size = self.sizeclass(nbytes)
+        free = self._free.get(size)
+        if free:
+            return free.pop()
+        return mmap.mmap(-1, size)
+
+    def put(self, buf):
+        free = self._free.setdefault(len(buf), [])
+        if len(free) < self.maxFree:
+            free.append(buf)
+        else:
+            buf.close()
+
+    def preallocate(self, nbytes, count):
+        size = self.sizeclass(nbytes)
+        free = self._free.setdefault(size, [])
+        free += [mmap.mmap(-1, size) for i in range(count - len(free))]
+
+    def clear(self):
+        for free in self._free.values():
+            [buf.close() for buf in free]
+        self._free = {}
+
+
+global_buffer_pool = AlignedBufferPool()
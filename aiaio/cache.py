@@ -0,0 +1,140 @@
+import asyncio
+from collections import OrderedDict
+
+
+class BlockCache:
+    """LRU cache of fixed size file blocks, shared by the files of a context
+
+    Blocks are keyed by (st_dev, st_ino, index), so files opened more than
+    once share them. They are only kept while the file is open through
+    the cache, since a closed file may be replaced by one reusing its
+    inode number. Concurrent misses on a block wait for a single read.
+    Only full blocks are kept, the short last block of a file is read each
+    time. Writes through AIO invalidate the blocks they overlap, writes by
+    other processes or by other means are not seen.
+    """
+
+    def __init__(self, maxBytes=64 << 20, blockSize=1 << 12):
+        self.maxBytes = maxBytes
+        self.blockSize = blockSize
+        # reads of more blocks bypass the cache
+        self.maxBlocks = max(1, maxBytes // blockSize // 4)
+        self._blocks = OrderedDict()
+        self._pending = {}
+        # the cached block indices and the open handles of each file
+        self._files = {}
+        self._handles = {}
+        self._bytes = 0
+        self.reset_stats()
+
+    def __str__(self):
+        return f'BlockCache({len(self._blocks)} x {self.blockSize}, {self._bytes}/{self.maxBytes} bytes)'
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, shared=self.shared,
+                    evictions=self.evictions, invalidations=self.invalidations,
+                    blocks=len(self._blocks), bytes=self._bytes)
+
+    def attach(self, file, truncate=False):
+        """Register an open handle of file, truncate drops its blocks"""
+        if truncate:
+            self.invalidate_file(file)
+        self._handles[file] = self._handles.get(file, 0) + 1
+
+    def detach(self, file):
+        """Unregister a handle of file, dropping its blocks with the last one"""
+        n = self._handles.pop(file) - 1
+        if n:
+            self._handles[file] = n
+        else:
+            self.invalidate_file(file)
+
+    def lookup(self, key):
+        data = self._blocks.get(key)
+        if data is not None:
+            self._blocks.move_to_end(key)
+            self.hits += 1
+        return data
+
+    def fetch(self, key, read):
+        """Await the data of a missing block, read with read() unless pending"""
+        fut = self._pending.get(key)
+        if fut is None:
+            self.misses += 1
+            fut = self._pending[key] = asyncio.ensure_future(read())
+            fut.add_done_callback(lambda fut: self._fetched(key, fut))
+        else:
+            self.shared += 1
+        # a cancelled reader does not cancel the read the others wait for
+        return asyncio.shield(fut)
+
+    def _fetched(self, key, fut):
+        if self._pending.get(key) is not fut:
+            # invalidated while in flight
+            return
+        del self._pending[key]
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        data = fut.result()
+        if len(data) == self.blockSize and key[0:2] in self._handles:
+            self._insert(key, data)
+
+    def _insert(self, key, data):
+        self._blocks[key] = data
+        self._files.setdefault(key[0:2], set()).add(key[2])
+        self._bytes += len(data)
+        while self._bytes > self.maxBytes:
+            k, old = self._blocks.popitem(last=False)
+            self._unindex(k)
+            self._bytes -= len(old)
+            self.evictions += 1
+
+    def _unindex(self, key):
+        indices = self._files[key[0:2]]
+        indices.discard(key[2])
+        if not indices:
+            del self._files[key[0:2]]
+
+    def _drop(self, key):
+        data = self._blocks.pop(key, None)
+        if data is not None:
+            self._unindex(key)
+            self._bytes -= len(data)
+            self.invalidations += 1
+        # a read in flight returns its data but does not cache it
+        self._pending.pop(key, None)
+
+    def invalidate(self, file, offset, nbytes):
+        """Drop the blocks of file overlapping [offset, offset+nbytes)"""
+        if nbytes <= 0:
+            return
+        bs = self.blockSize
+        first, last = offset // bs, (offset + nbytes - 1) // bs
+        indices = self._files.get(file, ())
+        if last - first >= len(indices) + len(self._pending):
+            # a large range, visit the blocks of the file instead
+            keys = [(*file, index) for index in indices if first <= index <= last]
+            keys += [key for key in self._pending if key[0:2] == file and first <= key[2] <= last]
+        else:
+            keys = [(*file, index) for index in range(first, last + 1)]
+        for key in keys:
+            self._drop(key)
+
+    def invalidate_file(self, file):
+        for index in list(self._files.get(file, ())):
+            self._drop((*file, index))
+        for key in [key for key in self._pending if key[0:2] == file]:
+            del self._pending[key]
+
+    def clear(self):
+        self._blocks.clear()
+        self._pending.clear()
+        self._files.clear()
+        self._bytes = 0
@@ -0,0 +1,395 @@
+import os
+import time
+import sys
+import heapq
+import bisect
+import asyncio
+
+from .stats import IOStats
+
+
+IO_CMD_PREAD = 0
+IO_CMD_PWRITE = 1
+
+IO_CMD_FSYNC = 2
+IO_CMD_FDSYNC = 3
+
+IO_CMD_POLL = 5
+IO_CMD_NOOP = 6
+
+IO_CMD_PREADV = 7
+IO_CMD_PWRITEV = 8
+
+PRIO_LATENCY = 0
+PRIO_NORMAL = 1
+PRIO_BACKGROUND = 2
+
+IOPRIO_CLASS_BE = 2
+
+# kernel I/O priority of each class, 0 keeps the priority of the process
+ioprio_values = {
+    PRIO_LATENCY: IOPRIO_CLASS_BE << 13 | 0,
+    PRIO_NORMAL: 0,
+    PRIO_BACKGROUND: IOPRIO_CLASS_BE << 13 | 7,
+}
+
+
+global_t0 = time.time()
+
+
+class IORequest:
+    __slots__ = ('slot', 'future', 'buf', 'nbytes', 'op', 't0', 'ctx', 'alloc')
+
+    def __init__(self, slot, future, buf=None, nbytes=0, ctx=None, alloc=None):
+        self.slot = slot
+        self.future = future
+        self.buf = buf
+        self.nbytes = nbytes
+        self.op = None
+        self.t0 = 0
+        self.ctx = ctx
+        # makes the pinned buffer when the request is admitted
+        self.alloc = alloc
+
+    def __await__(self):
+        try:
+            return (yield from self.future.__await__())
+        except asyncio.CancelledError:
+            if self.ctx is not None:
+                self.ctx.cancel_request(self)
+            raise
+
+    def release(self):
+        if self.buf is not None:
+            self.buf.release()
+            self.buf = None
+
+    def set_result(self, res):
+        self.release()
+        if self.future.done():
+            return
+        if res < 0:
+            self.future.set_exception(OSError(-res, os.strerror(-res)))
+        else:
+            self.future.set_result(res)
+
+    def set_exception(self, ex):
+        self.release()
+        if not self.future.done():
+            self.future.set_exception(ex)
+
+
+class FairQueue:
+    """Requests waiting for admission, dispatched weighted fair
+
+    Each (priority, fd) flow gets a share proportional to the weight of
+    its priority class: a request is tagged with the virtual time at which
+    its flow finishes it, and the smallest tag is dispatched first.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self._heap = []
+        self._finish = {}
+        self._vtime = 0
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def append(self, entry, flow, cost):
+        start = max(self._vtime, self._finish.get(flow, 0))
+        finish = start + cost / self.weights.get(flow[0], 1)
+        self._finish[flow] = finish
+        self._seq += 1
+        heapq.heappush(self._heap, (finish, self._seq, entry))
+
+    def peek(self):
+        return self._heap[0][2]
+
+    def popleft(self):
+        self._vtime, seq, entry = heapq.heappop(self._heap)
+        if not self._heap:
+            self._finish.clear()
+        return entry
+
+
+class FileRanges:
+    """Byte ranges of the pending requests on one file, keyed by integer ids"""
+
+    def __init__(self):
+        self.starts = []
+        self.ranges = {}
+        self.writes = set()
+        self.maxlen = 0
+
+    def conflicts(self, start, end, write):
+        """Slots of pending requests overlapping [start, end), if either writes"""
+        lo = bisect.bisect_left(self.starts, (start - self.maxlen, -1))
+        hi = bisect.bisect_left(self.starts, (end, -1))
+        return [slot for a, slot in self.starts[lo:hi]
+                if self.ranges[slot][1] > start and (write or self.ranges[slot][2])]
+
+    def add(self, slot, start, end, write):
+        bisect.insort(self.starts, (start, slot))
+        self.ranges[slot] = (start, end, write)
+        if write:
+            self.writes.add(slot)
+        self.maxlen = max(self.maxlen, end - start)
+
+    def remove(self, slot):
+        start, end, write = self.ranges.pop(slot)
+        del self.starts[bisect.bisect_left(self.starts, (start, slot))]
+        self.writes.discard(slot)
+
+
+class IOContextBase:
+    """Request bookkeeping shared by all backends
+
+    Subclasses fill in the backend request for a slot in _io_fill and
+    submit the queued requests in flush_submit_queue. Completions are
+    reported as (slot, res, res2) tuples to notify_cbcomplete_list.
+    """
+
+    _readsDict = {}
+    _backlog = None
+    _inflight = 0
+    _inflightBytes = 0
+    _submitQueue = []
+    _submitScheduled = False
+    _id = 0
+    _maxbatch = 1000
+    _maxsubmit = 256
+    # backlog weights of the priority classes and cost of a request in bytes
+    prioWeights = {PRIO_LATENCY: 16, PRIO_NORMAL: 4, PRIO_BACKGROUND: 1}
+    _requestCost = 1 << 16
+    _verbose = 0
+    _loop = None
+    _name = None
+    cache = None
+
+    def __init__(self, numRequests=10000, name=None, maxSubmit=None, buffers=None,
+                 maxInflight=None, maxInflightBytes=None, weights=None, cache=None):
+        self.numRequests = numRequests
+        self.maxInflight = numRequests if maxInflight is None else min(maxInflight, numRequests)
+        self.maxInflightBytes = maxInflightBytes
+        self._readsDict = {}
+        self._freeSlots = list(range(numRequests))
+        if weights is not None:
+            self.prioWeights = dict(self.prioWeights, **weights)
+        self._backlog = FairQueue(self.prioWeights)
+        self._inflight = 0
+        self._inflightBytes = 0
+        self.buffers = buffers
+        # BlockCache used by the reads of the files of this context
+        self.cache = cache
+        self._stats = IOStats()
+        self._submitQueue = []
+        self._submitScheduled = False
+        # pending writes per fd, from submission to completion
+        self._writes = {}
+        self._writing = {}
+        if maxSubmit is not None:
+            self._maxsubmit = maxSubmit
+        IOContextBase._id += 1
+        self._id = IOContextBase._id
+        if name is None:
+            name = f'ioctx-{self._id}'
+        self._name = name
+
+    def __str__(self):
+        return f'{type(self).__name__}({self._name}, n={self.numRequests})'
+
+    def log(self, msg):
+        print(f'{time.time() - global_t0: 12.3f} {self} {msg}')
+        sys.stdout.flush()
+
+    def stats(self):
+        stats = self._stats.as_dict(self._inflight)
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+    def reset_stats(self):
+        self._stats.reset()
+        if self.cache is not None:
+            self.cache.reset_stats()
+
+    def nowait_ok(self, fd, offset, nbytes):
+        """Whether a read may bypass the requests pending in this context
+
+        Not while an overlapping write is pending, also one that still
+        waits in the submit queue or the backlog.
+        """
+        ranges = self._writes.get(fd)
+        return ranges is None or not ranges.conflicts(offset, offset + nbytes, False)
+
+    def file_closed(self, fd):
+        """Called by an AIO before it closes fd"""
+        pass
+
+    def _track_write(self, item, fd, offset):
+        ranges = self._writes.get(fd)
+        if ranges is None:
+            ranges = self._writes[fd] = FileRanges()
+        ranges.add(id(item), offset, offset + item.nbytes, True)
+        self._writing[id(item)] = fd
+
+    def _untrack_write(self, item):
+        fd = self._writing.pop(id(item), None)
+        if fd is None:
+            return
+        ranges = self._writes[fd]
+        ranges.remove(id(item))
+        if not ranges.ranges:
+            del self._writes[fd]
+
+    def note_nowait(self, fd, hit):
+        if hit:
+            self._stats.nowait_hits += 1
+        else:
+            self._stats.nowait_misses += 1
+
+    def _io_submit_handler(self, nsubmitted):
+        pass
+
+    def _io_fill(self, slot, op, fd, address, nbytes, offset, prio):
+        raise NotImplementedError()
+
+    def flush_submit_queue(self):
+        raise NotImplementedError()
+
+    def _io_submit(self, op, fd, address=0, nbytes=0, offset=0, buf=None, prio=None, alloc=None):
+        """Queue a request, with alloc the nbytes buffer is made by alloc() once it is admitted"""
+        loop = asyncio.get_running_loop()
+        if alloc is not None:
+            item = IORequest(None, loop.create_future(), None, nbytes, self, alloc)
+        else:
+            item = IORequest(None, loop.create_future(), buf, buf.nbytes if buf is not None else 0, self)
+        if prio is None:
+            prio = PRIO_NORMAL
+        if op in (IO_CMD_PWRITE, IO_CMD_PWRITEV):
+            self._track_write(item, fd, offset)
+        if self._backlog or not self._admit(item.nbytes):
+            self._backlog.append((item, op, fd, address, nbytes, offset, prio), (prio, fd),
+                                 self._requestCost + item.nbytes)
+        else:
+            self._io_start(item, op, fd, address, nbytes, offset, prio)
+        return item
+
+    def _admit(self, nbytes):
+        if self._inflight >= self.maxInflight:
+            return False
+        # a single request larger than the byte budget is admitted when idle
+        return (self.maxInflightBytes is None or self._inflight == 0
+                or self._inflightBytes + nbytes <= self.maxInflightBytes)
+
+    def _io_start(self, item, op, fd, address, nbytes, offset, prio):
+        if item.alloc is not None:
+            item.buf = item.alloc()
+            item.alloc = None
+            address = item.buf.address
+        slot = self._freeSlots.pop()
+        self._io_fill(slot, op, fd, address, nbytes, offset, prio)
+        item.slot = slot
+        item.op = op
+        item.t0 = time.perf_counter()
+        self._inflight += 1
+        self._inflightBytes += item.nbytes
+        if self._inflight > self._stats.peak_inflight:
+            self._stats.peak_inflight = self._inflight
+        self._readsDict[slot] = item
+        self._submitQueue.append(item)
+        if len(self._submitQueue) >= self._maxsubmit:
+            self.flush_submit_queue()
+        elif not self._submitScheduled:
+            self._submitScheduled = True
+            asyncio.get_running_loop().call_soon(self.flush_submit_queue)
+
+    def _io_done(self, item):
+        self._inflight -= 1
+        self._inflightBytes -= item.nbytes
+        if self._writing:
+            self._untrack_write(item)
+
+    def cancel_request(self, item):
+        """Cancel a request whose awaiting task was cancelled
+
+        The slot and buffer of a request that reached the kernel are only
+        released by its completion, as the kernel may still access the buffer.
+        """
+        self._stats.cancelled += 1
+        if item.slot is None:
+            # still in the backlog, dispatch_backlog drops it
+            item.release()
+        elif self._readsDict.get(item.slot) is item and item not in self._submitQueue:
+            self._io_cancel(item)
+
+    def _io_cancel(self, item):
+        pass
+
+    def _take_submit_queue(self):
+        # the queued requests, without those cancelled before submission
+        queue, self._submitQueue = self._submitQueue, []
+        live = [item for item in queue if not item.future.done()]
+        if len(live) < len(queue):
+            self.retire_list([item for item in queue if item.future.done()])
+        return live
+
+    def retire_list(self, items):
+        # release requests that never reached the kernel
+        for item in items:
+            del self._readsDict[item.slot]
+            self._freeSlots.append(item.slot)
+            self._io_done(item)
+            item.release()
+        if self._backlog:
+            self.dispatch_backlog()
+
+    def dispatch_backlog(self):
+        backlog = self._backlog
+        while backlog and self._admit(backlog.peek()[0].nbytes):
+            item, *args = backlog.popleft()
+            if item.future.done():
+                # cancelled while waiting for admission
+                self._untrack_write(item)
+                item.release()
+                continue
+            self._io_start(item, *args)
+
+    def _io_submit_failed(self, item, rc, what='io_submit'):
+        self.log(f'Error {what}: {rc} {os.strerror(-rc)}')
+        del self._readsDict[item.slot]
+        self._freeSlots.append(item.slot)
+        self._io_done(item)
+        self._stats.failed += 1
+        item.set_exception(OSError(-rc, f'{what}: {os.strerror(-rc)}'))
+
+    def pop_cbcomplete_list(self, evlist):
+        completed = [(self._readsDict.pop(slot), res) for slot, res, res2 in evlist]
+        self._freeSlots.extend([slot for slot, res, res2 in evlist])
+        return completed
+
+    def resolve_cbcomplete_list(self, completed):
+        stats = self._stats
+        stats.reap_batches.add(len(completed))
+        t1 = time.perf_counter()
+        for item, res in completed:
+            self._io_done(item)
+            stats.complete(item.op, res, item.t0, t1)
+            item.set_result(res)
+        if self._backlog:
+            self.dispatch_backlog()
+
+    def notify_cbcomplete_list(self, evlist):
+        self.resolve_cbcomplete_list(self.pop_cbcomplete_list(evlist))
+
+    async def start(self):
+        await self.start_aio_suspend_loop()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        return await self.release()
@@ -0,0 +1,77 @@
+import os
+import asyncio
+
+from .iocontext_task import IOContext
+from .iocontext_task import IO_EVENT, TIMESPEC, IOCB_FLAG_RESFD, libaio, getename, events_list
+
+
+class IOContextEventFD(IOContext):
+
+    _efd = -1
+
+    def __init__(self, numRequests=100, **kw):
+        super().__init__(numRequests=numRequests, **kw)
+        self._efd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        self._events = (IO_EVENT * self._maxbatch)()
+        self._timeout = TIMESPEC() # == 0
+
+    def __str__(self):
+        return f'IOContextEventFD({self._name}, n={self.numRequests})'
+
+    def __repr__(self):
+        return f'IOContextEventFD({self._name}, n={self.numRequests}, {bytes(self._ctx).hex()})'
+
+    def closectx(self):
+        super().closectx()
+        if self._efd >= 0:
+            os.close(self._efd)
+            self._efd = -1
+
+    def _io_prep(self, cb):
+        cb.uc.flags |= IOCB_FLAG_RESFD
+        cb.uc.resfd = self._efd
+
+    def reap_events(self):
+        try:
+            os.eventfd_read(self._efd)
+        except BlockingIOError:
+            return
+        evlist = self.reap_ring()
+        if evlist is not None:
+            if evlist:
+                self.notify_cbcomplete_list(evlist)
+            return
+        nevents = self._maxbatch
+        events = self._events
+        while True:
+            rc = libaio.io_getevents(self._ctx, 0, nevents, events, self._timeout)
+            if self._verbose:
+                self.log(f'io_getevents = {rc}')
+            if rc < 0:
+                self.log(f'Error io_getevents: {rc} {getename(-rc)}')
+                raise OSError(f'io_getevents: {getename(-rc)}')
+            if rc > 0:
+                self.notify_cbcomplete_list(events_list(events, rc))
+            if rc < nevents:
+                break
+
+    async def start_aio_suspend_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self.releaseThread()
+            self._loop = loop
+            self._loop.add_reader(self._efd, self.reap_events)
+            if self._verbose:
+                self.log(f'eventfd {self._efd} reader added')
+
+    def releaseThread(self):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._efd)
+            if self._verbose:
+                self.log(f'eventfd {self._efd} reader removed')
+        self._loop = None
+
+    async def release(self):
+        if self._verbose:
+            self.log(f'release')
+        self.releaseThread()
@@ -1,19 +1,37 @@
 from .iocontext_task import IOContext
+import os
 import threading
+import time
 import asyncio
+from collections import deque
 
-from .iocontext_task import IO_EVENT, TIMESPEC, SIGSET, libaio, addressof, getename
+from .iocontext_task import IO_EVENT, TIMESPEC, SIGSET, libaio, getename, events_list
 
 
 class IOContextMT(IOContext):
 
     _thread = None
     _thread_stop = False
+    _submitter = None
+    # seconds the reaper waits for pending requests after release
+    _stopTimeout = 10
+    _pollHits = 0
+    _pollMisses = 0
 
-    def __init__(self, numRequests=100, **kw):
+    def __init__(self, numRequests=100, submitThread=False, pollWindow=None, pollCpu=None, **kw):
         super().__init__(numRequests=numRequests, **kw)
+        # with pollWindow, the reaper busy polls for up to that many seconds
+        # after activity before it blocks, optionally pinned to pollCpu
+        self.pollWindow = pollWindow
+        self.pollCpu = pollCpu
+        self._spinWindow = pollWindow or 0
         self._thread_empty = threading.Event()
         self._thread_stopped = asyncio.Event()
+        # with submitThread, io_submit is called by a submitter thread and
+        # the loop only hands over the queued requests
+        self.submitThread = submitThread
+        self._submitPending = deque()
+        self._submitReady = threading.Event()
 
     def __str__(self):
         return f'IOContextMT({self._name}, n={self.numRequests})'
@@ -21,6 +39,53 @@ class IOContextMT(IOContext):
     def __repr__(self):
         return f'IOContextMT({self._name}, n={self.numRequests}, {bytes(self._ctx).hex()})'
 
+    def stats(self):
+        stats = super().stats()
+        if self.pollWindow:
+            stats['poll'] = dict(hits=self._pollHits, misses=self._pollMisses,
+                                 window_us=self._spinWindow * 1e6)
+        return stats
+
+    def _poll(self, nevents, events):
+        # completions available without blocking, from the ring if mapped
+        evlist = self.reap_ring()
+        if evlist is None:
+            rc = libaio.io_getevents(self._ctx, 0, nevents, events, TIMESPEC())
+            if rc < 0:
+                self._notify_events(rc, events)
+            evlist = events_list(events, rc)
+        return evlist
+
+    def _spin(self, nevents, events):
+        # poll until completions arrive or the window ends
+        deadline = time.perf_counter() + self._spinWindow
+        while not self._thread_stop and time.perf_counter() < deadline:
+            if self._readsDict:
+                evlist = self._poll(nevents, events)
+                if evlist:
+                    return evlist
+            # let the loop thread take the GIL
+            os.sched_yield()
+        return []
+
+    def _adapt(self, t0, hit):
+        # shrink the window while spinning finds nothing, grow it again
+        # when blocking waits turn out shorter than the window
+        window = self.pollWindow
+        if hit:
+            self._pollHits += 1
+        elif t0 is None:
+            self._pollMisses += 1
+            self._spinWindow = self._spinWindow / 2 if self._spinWindow > window / 64 else 0
+        elif time.perf_counter() - t0 < window:
+            self._spinWindow = min(window, max(2 * self._spinWindow, window / 16))
+
+    def _notify_events(self, rc, events):
+        if rc < 0:
+            self.log(f'Error io_pgetevents: {rc} {getename(-rc)}')
+            raise OSError(f'io_pgetevents: {getename(-rc)}')
+        self.notify_cbcomplete_list(events_list(events, rc))
+
     def run_getevents_loop1(self):
         nevents = self._maxbatch
         events = (IO_EVENT * nevents)()
@@ -28,29 +93,51 @@ class IOContextMT(IOContext):
         timeout.tv_sec = 1
         sigmask = SIGSET()
         libaio.sigfillset(sigmask)
+        if self.pollCpu is not None:
+            os.sched_setaffinity(0, {self.pollCpu})
 
+        stopping = None
         while not self._thread_stop or len(self._readsDict) > 0:
+            if self._thread_stop:
+                if stopping is None:
+                    stopping = time.monotonic()
+                elif time.monotonic() - stopping > self._stopTimeout:
+                    # they are reaped when the thread is started again
+                    self.log(f'{len(self._readsDict)} requests still pending, stop waiting')
+                    break
+            if self._spinWindow:
+                evlist = self._spin(nevents, events)
+                self._adapt(None, len(evlist) > 0)
+            else:
+                evlist = self.reap_ring()
+            if evlist:
+                self.notify_cbcomplete_list(evlist)
+                continue
             if self._verbose:
                 self.log(f'io_pgetevents...')
             if len(self._readsDict) == 0:
                 timeout.tv_sec = 0
             else:
                 timeout.tv_sec = 1
+            t0 = time.perf_counter()
             rc = libaio.io_pgetevents(self._ctx, 1, nevents, events, timeout, sigmask)
             if self._verbose:
                 self.log(f'io_pgetevents = {rc}')
-            if rc > 0:
-                evlist = [(addressof(events[i].obj.contents), events[i].res, events[i].res2) for i in range(rc)]
-                self.notify_cbcomplete_list(evlist)
-            elif rc < 0:
-                self.log(f'Error io_pgetevents: {rc} {getename(-rc)}')
-                raise OSError(f'io_pgetevents: {getename(-rc)}')
-            elif rc == 0:
+            if rc > 0 and self.pollWindow:
+                self._adapt(t0, False)
+            if rc != 0:
+                self._notify_events(rc, events)
+            else:
                 if len(self._readsDict) == 0 and not self._thread_stop:
                     if self._verbose:
                         self.log(f'{rc}=0 and no pending: go to sleep')
                     self._thread_empty.clear()
-                    self._thread_empty.wait()
+                    # a request submitted before the clear would not wake us
+                    if len(self._readsDict) == 0:
+                        t0 = time.perf_counter()
+                        self._thread_empty.wait()
+                        if self.pollWindow:
+                            self._adapt(t0, False)
         if self._verbose:
             self.log(f'task io_pgetevents exiting')
         self.notify_thread_exit()
@@ -64,11 +151,40 @@ class IOContextMT(IOContext):
             self.log(f'task pgetevents raise exception {ex}')
             raise ex
 
+    def flush_submit_queue(self):
+        if not self.submitThread:
+            return super().flush_submit_queue()
+        self._submitScheduled = False
+        queue = self._take_submit_queue()
+        self._submitPending.append(queue)
+        self._submitReady.set()
+
+    def run_submit_loop(self):
+        pending = self._submitPending
+        while True:
+            self._submitReady.wait()
+            self._submitReady.clear()
+            while pending:
+                queue = pending.popleft()
+                while pending and len(queue) < self._maxsubmit:
+                    queue += pending.popleft()
+                live, cancelled = [], []
+                for item in queue:
+                    (cancelled if item.future.done() else live).append(item)
+                if cancelled:
+                    self._loop.call_soon_threadsafe(self.retire_list, cancelled)
+                batches, failed = self._submit_list(live)
+                if batches or failed:
+                    # the stats are only updated on the loop thread
+                    self._loop.call_soon_threadsafe(self.submit_done_list, batches, failed)
+            if self._thread_stop:
+                break
+        if self._verbose:
+            self.log(f'submit thread exiting')
+
     def notify_cbcomplete_list(self, evlist):
-         future = asyncio.run_coroutine_threadsafe(self.notify_cbcomplete_list_task(evlist), loop=self._loop)
-         res = future.result()
-         assert res == 0
-         return res
+        completed = self.pop_cbcomplete_list(evlist)
+        self._loop.call_soon_threadsafe(self.resolve_cbcomplete_list, completed)
 
     async def start_aio_suspend_loop(self):
         self._loop = asyncio.get_event_loop()
@@ -80,6 +196,9 @@ class IOContextMT(IOContext):
             self._thread.start()
             if self._verbose:
                 self.log(f'io_pgetevents thread started')
+        if self.submitThread and self._submitter is None:
+            self._submitter = threading.Thread(target=self.run_submit_loop)
+            self._submitter.start()
 
     async def notify_thread_exit_task(self):
         if self._verbose:
@@ -108,6 +227,7 @@ class IOContextMT(IOContext):
             self.log(f'releaseThread')
         self._thread_stop = True
         self._thread_empty.set()
+        self._submitReady.set()
 
     async def awaitThread(self):
         if self._verbose:
@@ -121,6 +241,11 @@ class IOContextMT(IOContext):
             if self._verbose:
                 print('Thread has stopped')
             await self.waitForThread()
+        if self._submitter is not None:
+            while self._submitter.is_alive():
+                self._submitReady.set()
+                await asyncio.sleep(1e-3)
+            self._submitter = None
         self._thread = None
         self._loop = None
 
@@ -137,11 +262,11 @@ class IOContextMT(IOContext):
     async def __aexit__(self, *args):
         return await self.release()
 
-    def _io_submit_handler(self, cb):
+    def _io_submit_handler(self, nsubmitted):
         if self._verbose:
             self.log(f'set event')
         self._thread_empty.set()
 
 
-global_context_mt = IOContextMT(numRequests=1000)
-global_contexts_mt = [global_context_mt]
+global_context_mt = IOContextMT(numRequests=1000) if libaio is not None else None
+global_contexts_mt = [global_context_mt] if libaio is not None else []
@@ -0,0 +1,79 @@
+import os
+import asyncio
+
+from .iocontext_mt import IOContextMT
+from .stats import IOStats
+
+
+class IOContextPool:
+    """Contexts sharding the requests, numRequests is the total over all shards"""
+
+    _id = 0
+    _next = 0
+
+    def __init__(self, numShards=None, numRequests=10000, name=None, spread='file',
+                 context=IOContextMT, buffers=None, cache=None, **kw):
+        if spread not in ('file', 'roundrobin'):
+            raise ValueError(f'spread must be "file" or "roundrobin": {spread}')
+        if numShards is None:
+            numShards = os.cpu_count()
+        IOContextPool._id += 1
+        if name is None:
+            name = f'iopool-{IOContextPool._id}'
+        self._name = name
+        self._spread = spread
+        # kernel events are limited system wide by aio-max-nr
+        perShard = max(1, -(-numRequests // numShards))
+        self.shards = [context(perShard, name=f'{name}.{i}', buffers=buffers, cache=cache, **kw)
+                       for i in range(numShards)]
+        self.numRequests = perShard * numShards
+        self.buffers = buffers
+        self.cache = cache
+        self._next = 0
+
+    def __str__(self):
+        return f'IOContextPool({self._name}, {len(self.shards)}x{self.shards[0].numRequests}, {self._spread})'
+
+    def shard(self, fd):
+        if self._spread == 'file':
+            return self.shards[fd % len(self.shards)]
+        self._next = (self._next + 1) % len(self.shards)
+        return self.shards[self._next]
+
+    def stats(self):
+        total = IOStats()
+        [total.merge(ctx._stats) for ctx in self.shards]
+        stats = total.as_dict(sum(ctx._inflight for ctx in self.shards))
+        stats['peak_shard_inflight'] = stats.pop('peak_inflight')
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+    def reset_stats(self):
+        [ctx.reset_stats() for ctx in self.shards]
+
+    def nowait_ok(self, fd, offset, nbytes):
+        return all(ctx.nowait_ok(fd, offset, nbytes) for ctx in self.shards)
+
+    def file_closed(self, fd):
+        [ctx.file_closed(fd) for ctx in self.shards]
+
+    def note_nowait(self, fd, hit):
+        self.shards[fd % len(self.shards)].note_nowait(fd, hit)
+
+    def _io_submit(self, op, fd, address=0, nbytes=0, offset=0, buf=None, prio=None, alloc=None):
+        return self.shard(fd)._io_submit(op, fd, address, nbytes, offset, buf, prio, alloc)
+
+    async def start(self):
+        for ctx in self.shards:
+            await ctx.start()
+
+    async def release(self):
+        await asyncio.gather(*[ctx.release() for ctx in self.shards])
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        return await self.release()
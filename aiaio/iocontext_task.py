@@ -1,19 +1,17 @@
 from ctypes import c_short, c_int, c_uint, c_long, c_longlong, c_uint8, c_int64, c_uint64, c_voidp
-from ctypes import CDLL, pointer, POINTER, Structure, addressof
+from ctypes import CDLL, POINTER, Structure, addressof, sizeof, c_char, string_at
 import errno
-import time
-import sys
+import struct
 import asyncio
 
+from .iocontext_base import IOContextBase, ioprio_values
+# re-exported for aio
+from .iocontext_base import IO_CMD_PREAD, IO_CMD_PWRITE, IO_CMD_FSYNC, IO_CMD_FDSYNC  # noqa: F401
+from .iocontext_base import IO_CMD_PREADV, IO_CMD_PWRITEV  # noqa: F401
 
-IO_CMD_PREAD = 0
-IO_CMD_PWRITE = 1
 
-IO_CMD_FSYNC = 2
-IO_CMD_FDSYNC = 3
-
-IO_CMD_POLL = 5
-IO_CMD_NOOP = 6
+IOCB_FLAG_RESFD = 1 << 0
+IOCB_FLAG_IOPRIO = 1 << 1
 
 
 c_off_t = c_int64
@@ -22,8 +20,6 @@ c_size_tp = POINTER(c_size_t)
 c_uint8p = POINTER(c_uint8)
 
 
-global_t0 = time.time()
-
 
 def getename(c):
     if c == 0: return 'SUCCESS'
@@ -56,11 +52,12 @@ class IO_CONTEXT(Structure):
 class IOCB_COMMON(Structure):
     _pack_ = 1
     _fields_ = [
-        ("buf", c_uint8p),              # + 8
+        ("buf", c_voidp),               # + 8
         ("nbytes", c_long),             # + 8
         ("offset", c_longlong),         # + 8
         ("_pad3", c_longlong),          # + 8
-        ("_pad4", c_longlong),          # + 8 == 0x28
+        ("flags", c_uint),              # + 4
+        ("resfd", c_uint),              # + 4 == 0x28
         ]
 
 
@@ -87,6 +84,35 @@ class IO_EVENT(Structure):
         ]
 
 
+class AIO_RING(Structure):
+    _pack_ = 1
+    _fields_ = [
+        ("id", c_uint),                 # + 4
+        ("nr", c_uint),                 # + 4
+        ("head", c_uint),               # + 4
+        ("tail", c_uint),               # + 4 == 0x10
+        ("magic", c_uint),              # + 4
+        ("compat_features", c_uint),    # + 4
+        ("incompat_features", c_uint),  # + 4
+        ("header_length", c_uint),      # + 4 == 0x20
+        ]
+
+
+AIO_RING_MAGIC = 0xa10a10a1
+
+# IO_EVENT as (data, obj, res, res2)
+io_event_struct = struct.Struct('QQqq')
+
+
+def unpack_events(buf):
+    """(data, res, res2) of the IO_EVENTs in a bytes-like object"""
+    return [(data, res, res2) for data, obj, res, res2 in io_event_struct.iter_unpack(buf)]
+
+
+def events_list(events, n):
+    return unpack_events(string_at(events, n * sizeof(IO_EVENT)))
+
+
 TIMESPECp = POINTER(TIMESPEC)
 SIGSETp = POINTER(SIGSET)
 IO_CONTEXTp = POINTER(IO_CONTEXT)
@@ -96,6 +122,7 @@ IO_EVENTp = POINTER(IO_EVENT)
 IO_EVENTpp = POINTER(IO_EVENTp)
 
 libnames = ['libaio.so.1t64', 'libaio.so.1']
+libaio = None
 for n in libnames:
     try:
         libaio = CDLL(n)
@@ -104,26 +131,30 @@ for n in libnames:
         pass
 
 
-libaio.io_setup.argtypes = [c_int, IO_CONTEXTp]
-libaio.io_setup.restype = c_int
+if libaio is not None:
+    libaio.io_setup.argtypes = [c_int, IO_CONTEXTp]
+    libaio.io_setup.restype = c_int
 
-libaio.io_destroy.argtypes = [IO_CONTEXT]
-libaio.io_destroy.restype = c_int
+    libaio.io_destroy.argtypes = [IO_CONTEXT]
+    libaio.io_destroy.restype = c_int
 
-libaio.io_submit.argtypes = [IO_CONTEXT, c_long, IOCBpp]
-libaio.io_submit.restype = c_int
+    libaio.io_submit.argtypes = [IO_CONTEXT, c_long, POINTER(c_voidp)]
+    libaio.io_submit.restype = c_int
 
-libaio.io_getevents.argtypes = [IO_CONTEXT, c_long, c_long, IO_EVENTp, TIMESPECp]
-libaio.io_getevents.restype = c_int
+    libaio.io_cancel.argtypes = [IO_CONTEXT, c_voidp, IO_EVENTp]
+    libaio.io_cancel.restype = c_int
 
-libaio.io_pgetevents.argtypes = [IO_CONTEXT, c_long, c_long, IO_EVENTp, TIMESPECp, SIGSETp]
-libaio.io_pgetevents.restype = c_int
+    libaio.io_getevents.argtypes = [IO_CONTEXT, c_long, c_long, IO_EVENTp, TIMESPECp]
+    libaio.io_getevents.restype = c_int
 
-libaio.sigfillset.argtypes = [SIGSETp]
-libaio.sigemptyset.argtypes = [SIGSETp]
-libaio.sigaddset.argtypes = [SIGSETp, c_int]
-libaio.sigdelset.argtypes = [SIGSETp, c_int]
-libaio.sigprocmask.argtypes = [c_int, SIGSETp, SIGSETp]
+    libaio.io_pgetevents.argtypes = [IO_CONTEXT, c_long, c_long, IO_EVENTp, TIMESPECp, SIGSETp]
+    libaio.io_pgetevents.restype = c_int
+
+    libaio.sigfillset.argtypes = [SIGSETp]
+    libaio.sigemptyset.argtypes = [SIGSETp]
+    libaio.sigaddset.argtypes = [SIGSETp, c_int]
+    libaio.sigdelset.argtypes = [SIGSETp, c_int]
+    libaio.sigprocmask.argtypes = [c_int, SIGSETp, SIGSETp]
 
 
 try:
@@ -141,38 +172,76 @@ except BaseException as ex:
     pass
 
 
-class IOContext:
+class IOContext(IOContextBase):
 
-    _readsDict = {}
-    _id = 0
-    _maxbatch = 1000
-    _verbose = 0
     _task = None
-    _loop = None
     _loops = 0
-    _name = None
-
-    def __init__(self, numRequests=10000, name=None):
-        self.numRequests = numRequests
+    _ctx = None
+    _ring = None
+    # cleared when the kernel rejects IOCB_FLAG_IOPRIO
+    _ioprio = True
+
+    def __init__(self, numRequests=10000, ringReap=True, **kw):
+        if libaio is None:
+            raise OSError(errno.ENOSYS, f'libaio not found: {", ".join(libnames)}')
+        super().__init__(numRequests=numRequests, **kw)
         self._ctx = IO_CONTEXT()
         rc = libaio.io_setup(numRequests, self._ctx)
         if rc < 0:
             raise OSError(f'io_setup: {getename(-rc)}')
-        self._readsDict = {}
+        self._iocbs = (IOCB * numRequests)()
+        self._iocbsAddr = addressof(self._iocbs)
+        self._submitArray = (c_voidp * self._maxsubmit)()
+        self._cancelEvent = IO_EVENT()
         self._task = None
-        IOContext._id += 1
-        self._id = IOContext._id
-        if name is None:
-            name = f'ioctx-{self._id}'
-        self._name = name
+        if ringReap:
+            self._map_ring()
 
     def __del__(self):
+        if self._ctx is None:
+            return
         assert self._task is None
         self.releaseThread()
         self.closectx()
         self.numRequests = -1
 
+    def _map_ring(self):
+        # the context id is the address of the kernel's completion ring,
+        # which is mapped into the process
+        ring = AIO_RING.from_address(self._ctx.buf)
+        if ring.magic != AIO_RING_MAGIC or ring.incompat_features != 0:
+            if self._verbose:
+                self.log(f'no user mapped aio ring, using io_getevents')
+            return
+        self._ring = ring
+        self._ringSize = ring.nr
+        self._ringEvents = memoryview((c_char * (ring.nr * sizeof(IO_EVENT))).from_address(
+            self._ctx.buf + ring.header_length)).cast('B')
+
+    def reap_ring(self):
+        """Consume the completions in the user mapped ring without a system call
+
+        Returns a list of (data, res, res2), or None without a mapped ring.
+        Only one thread may reap a context at a time.
+        """
+        ring = self._ring
+        if ring is None:
+            return None
+        nr = self._ringSize
+        head = ring.head % nr
+        tail = ring.tail % nr
+        if head == tail:
+            return []
+        size = sizeof(IO_EVENT)
+        if head < tail:
+            evlist = unpack_events(self._ringEvents[head * size:tail * size])
+        else:
+            evlist = unpack_events(self._ringEvents[head * size:]) + unpack_events(self._ringEvents[0:tail * size])
+        ring.head = tail
+        return evlist
+
     def closectx(self):
+        self._ring = None
         if self._ctx:
             rc = libaio.io_destroy(self._ctx)
             if -rc == errno.EINVAL:
@@ -186,26 +255,89 @@ class IOContext:
     def __repr__(self):
         return f'IOContext({self._name}, n={self.numRequests}, {bytes(self._ctx).hex()})'
 
-    def log(self, msg):
-        print(f'{time.time() - global_t0: 12.3f} {self} {msg}')
-        sys.stdout.flush()
-
-    def _io_submit_handler(self, cb):
+    def _io_prep(self, cb):
         pass
 
-    def _io_submit(self, cb):
-        rc = libaio.io_submit(self._ctx, 1, pointer(cb))
-        if rc < 0:
-            self.log(f'Error io_submit: {rc} {getename(-rc)}')
-            raise OSError(f'io_submit: {getename(-rc)}')
-        if rc == 1:
-            cbid = addressof(cb)
-            self._readsDict[cbid] = item = dict(cb=cb,cond=asyncio.Condition())
-            self._io_submit_handler(cb)
-            return item
-        else:
-            self.log(f'io_submit returned wrong code: {rc}')
-            raise OSError(f'io_submit: code {rc}')
+    def _io_fill(self, slot, op, fd, address, nbytes, offset, prio):
+        cb = self._iocbs[slot]
+        cb.data = slot
+        cb.aio_rw = 0
+        cb.aio_lio_opcode = op
+        cb.aio_fildes = fd
+        cb.uc.buf = address
+        cb.uc.nbytes = nbytes
+        cb.uc.offset = offset
+        ioprio = ioprio_values.get(prio, 0) if self._ioprio else 0
+        cb.aio_reqprio = ioprio
+        cb.uc.flags = IOCB_FLAG_IOPRIO if ioprio else 0
+        self._io_prep(cb)
+
+    def _clear_ioprio(self, queue):
+        self.log(f'io_submit does not support IOCB_FLAG_IOPRIO')
+        self._ioprio = False
+        for item in queue:
+            cb = self._iocbs[item.slot]
+            cb.aio_reqprio = 0
+            cb.uc.flags &= ~IOCB_FLAG_IOPRIO
+
+    def flush_submit_queue(self):
+        self._submitScheduled = False
+        queue = self._take_submit_queue()
+        self.submit_done_list(*self._submit_list(queue))
+
+    def _io_cancel(self, item):
+        rc = libaio.io_cancel(self._ctx, self._iocbsAddr + item.slot * sizeof(IOCB), self._cancelEvent)
+        if self._verbose:
+            self.log(f'io_cancel = {rc}')
+        if rc == 0:
+            # kernels before 4.19 return the completion here, not in the ring
+            self.notify_cbcomplete_list([(item.slot, -errno.ECANCELED, 0)])
+
+    def _submit_list(self, queue):
+        # Submit the queued requests, at most _maxsubmit IOCBs per io_submit
+        # call, and return the sizes of the accepted batches and the
+        # rejected requests with their error code
+        cbs = self._submitArray
+        size = sizeof(IOCB)
+        nsubmitted = 0
+        batches = []
+        failed = []
+        pos = 0
+        while pos < len(queue):
+            batch = queue[pos:pos + self._maxsubmit]
+            n = len(batch)
+            cbs[0:n] = [self._iocbsAddr + item.slot * size for item in batch]
+            rc = libaio.io_submit(self._ctx, n, cbs)
+            if rc == -errno.EINVAL and self._ioprio and self._iocbs[batch[0].slot].uc.flags & IOCB_FLAG_IOPRIO:
+                # kernels before 4.18 reject the flag: retry without priorities
+                self._clear_ioprio(queue[pos:])
+                continue
+            if rc < 0:
+                # the first IOCB of the batch was rejected
+                failed.append((batch[0], rc))
+                pos += 1
+            elif rc == 0:
+                self.log(f'io_submit returned wrong code: {rc}')
+                failed.append((batch[0], -errno.EIO))
+                pos += 1
+            else:
+                # partial submission: resubmit the rest
+                batches.append(rc)
+                nsubmitted += rc
+                pos += rc
+        if nsubmitted > 0:
+            self._io_submit_handler(nsubmitted)
+        return batches, failed
+
+    def submit_done_list(self, batches, failed):
+        # account for a _submit_list call on the loop thread
+        for n in batches:
+            self._stats.submit_batches.add(n)
+        self._stats.submitted += sum(batches)
+        for item, rc in failed:
+            self._io_submit_failed(item, rc)
+        if failed and self._backlog:
+            asyncio.get_running_loop().call_soon(self.dispatch_backlog)
 
     async def run_getevents_loop1(self):
         nevents = self._maxbatch
@@ -215,10 +347,13 @@ class IOContext:
         libaio.sigfillset(sigmask)
 
         while True:
+            evlist = self.reap_ring()
+            if evlist:
+                self.notify_cbcomplete_list(evlist)
+                continue
             rc = libaio.io_pgetevents(self._ctx, 1, nevents, events, timeout, sigmask)
             if rc > 0:
-                evlist = [(addressof(events[i].obj.contents), events[i].res, events[i].res2) for i in range(rc)]
-                await self.notify_cbcomplete_list_task(evlist)
+                self.notify_cbcomplete_list(events_list(events, rc))
             elif rc < 0:
                 self.log(f'Error io_pgetevents: {rc} {getename(-rc)}')
                 raise OSError(f'io_pgetevents: {getename(-rc)}')
@@ -237,18 +372,6 @@ class IOContext:
             self.log(f'task pgetevents raise exception {ex}')
             raise ex
 
-    async def notify_cbcomplete_task(self, cbid, res, res2):
-        dentry = self._readsDict[cbid]
-        async with dentry['cond']:
-            dentry['code'] = res
-            dentry['cond'].notify()
-        del self._readsDict[cbid]
-
-    async def notify_cbcomplete_list_task(self, evlist):
-        async with asyncio.TaskGroup() as gr:
-            [gr.create_task(self.notify_cbcomplete_task(*entry)) for entry in evlist]
-        return 0
-
     async def start_aio_suspend_loop(self):
         self._loops += 1
         if self._loop:
@@ -262,9 +385,6 @@ class IOContext:
             if self._verbose:
                 self.log(f'io_pgetevents task starting')
 
-    async def start(self):
-        await self.start_aio_suspend_loop()
-
     def releaseThread(self):
         if self._task is not None:
             self.log(f'releaseThread')
@@ -276,13 +396,6 @@ class IOContext:
         self.log(f'release')
         self.releaseThread()
 
-    async def __aenter__(self):
-        await self.start()
-        return self
-
-    async def __aexit__(self, *args):
-        return await self.release()
-
 
-global_context = IOContext(1000)
-global_contexts = [global_context]
+global_context = IOContext(1000) if libaio is not None else None
+global_contexts = [global_context] if libaio is not None else []
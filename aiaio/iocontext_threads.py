@@ -0,0 +1,156 @@
+import os
+import errno
+import threading
+import asyncio
+import concurrent.futures
+from ctypes import c_char
+
+from .iocontext_base import IOContextBase, FileRanges
+from .iocontext_base import IO_CMD_PREAD, IO_CMD_PWRITE, IO_CMD_FSYNC, IO_CMD_FDSYNC
+from .iocontext_base import IO_CMD_NOOP, IO_CMD_PREADV, IO_CMD_PWRITEV
+from .buffers import IOVEC
+
+
+def views(address, nbytes, count=None):
+    """Memoryviews of a buffer, or of the count IOVECs at address"""
+    if count is None:
+        return [memoryview((c_char * nbytes).from_address(address)).cast('B')]
+    return [memoryview((c_char * v.iov_len).from_address(v.iov_base)).cast('B') if v.iov_len else bytearray()
+            for v in (IOVEC * count).from_address(address)]
+
+
+class IOContextThreadPool(IOContextBase):
+    """IO context running blocking pread/pwrite calls on a thread pool
+
+    Works without libaio, and does not block the event loop on buffered
+    files, where io_submit performs the I/O synchronously. As there,
+    overlapping requests on a file take effect in submission order, and
+    fsync waits for the pending writes.
+    """
+
+    _executor = None
+
+    def __init__(self, numRequests=10000, numThreads=None, **kw):
+        super().__init__(numRequests=numRequests, **kw)
+        if numThreads is None:
+            numThreads = min(32, (os.cpu_count() or 1) + 4)
+        self.numThreads = numThreads
+        self._prep = [None] * numRequests
+        self._lock = threading.Lock()
+        self._done = []
+        self._files = {}
+        self._blocked = {}
+        self._dependents = {}
+
+    def __str__(self):
+        return f'IOContextThreadPool({self._name}, n={self.numRequests}, threads={self.numThreads})'
+
+    def _io_fill(self, slot, op, fd, address, nbytes, offset, prio):
+        # the pool threads run at the priority of the process
+        self._prep[slot] = (op, fd, address, nbytes, offset)
+
+    def flush_submit_queue(self):
+        self._submitScheduled = False
+        queue = self._take_submit_queue()
+        for item in queue:
+            slot = item.slot
+            op, fd, address, nbytes, offset = self._prep[slot]
+            ranges = self._files.get(fd)
+            if ranges is None:
+                ranges = self._files[fd] = FileRanges()
+            if op in (IO_CMD_FSYNC, IO_CMD_FDSYNC):
+                deps = list(ranges.writes)
+            else:
+                write = op in (IO_CMD_PWRITE, IO_CMD_PWRITEV)
+                deps = ranges.conflicts(offset, offset + item.nbytes, write)
+                ranges.add(slot, offset, offset + item.nbytes, write)
+            if deps:
+                self._blocked[slot] = len(deps)
+                for dep in deps:
+                    self._dependents.setdefault(dep, []).append(slot)
+            else:
+                self._start(slot)
+        self._stats.submit_batches.add(len(queue))
+        self._stats.submitted += len(queue)
+
+    def _start(self, slot):
+        if self._executor is None:
+            # also after release, for requests that waited behind others
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.numThreads, thread_name_prefix=self._name)
+        self._executor.submit(self._run, asyncio.get_running_loop(), slot, *self._prep[slot])
+
+    def _finish(self, slot):
+        fd = self._prep[slot][1]
+        self._prep[slot] = None
+        ranges = self._files.get(fd)
+        if ranges is not None:
+            if slot in ranges.ranges:
+                ranges.remove(slot)
+            if not ranges.ranges:
+                del self._files[fd]
+        for dep in self._dependents.pop(slot, ()):
+            self._blocked[dep] -= 1
+            if self._blocked[dep] == 0:
+                del self._blocked[dep]
+                self._start(dep)
+
+    def _run(self, loop, slot, op, fd, address, nbytes, offset):
+        item = self._readsDict.get(slot)
+        try:
+            if item is not None and item.future.cancelled():
+                # cancelled while queued in the pool
+                res = -errno.ECANCELED
+            elif op == IO_CMD_PREAD:
+                res = os.preadv(fd, views(address, nbytes), offset)
+            elif op == IO_CMD_PWRITE:
+                res = os.pwritev(fd, views(address, nbytes), offset)
+            elif op == IO_CMD_PREADV:
+                res = os.preadv(fd, views(address, 0, nbytes), offset)
+            elif op == IO_CMD_PWRITEV:
+                res = os.pwritev(fd, views(address, 0, nbytes), offset)
+            elif op == IO_CMD_FSYNC:
+                res = os.fsync(fd) or 0
+            elif op == IO_CMD_FDSYNC:
+                res = os.fdatasync(fd) or 0
+            elif op == IO_CMD_NOOP:
+                res = 0
+            else:
+                res = -errno.EINVAL
+        except OSError as ex:
+            res = -ex.errno
+        # wake the loop once per batch of completions
+        with self._lock:
+            self._done.append((slot, res, 0))
+            if len(self._done) > 1:
+                return
+        try:
+            loop.call_soon_threadsafe(self.reap_events)
+        except RuntimeError:
+            # the loop was closed while the request ran
+            pass
+
+    def reap_events(self):
+        with self._lock:
+            evlist, self._done = self._done, []
+        for slot, res, res2 in evlist:
+            self._finish(slot)
+        if evlist:
+            self.notify_cbcomplete_list(evlist)
+        if self._loop is None and not self._readsDict:
+            self.releaseThread()
+
+    async def start_aio_suspend_loop(self):
+        self._loop = asyncio.get_running_loop()
+
+    def releaseThread(self):
+        if self._executor is not None:
+            # started requests still run, those waiting for them start on a
+            # new executor, released again once all requests completed
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._loop = None
+
+    async def release(self):
+        if self._verbose:
+            self.log(f'release')
+        self.releaseThread()
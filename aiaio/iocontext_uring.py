@@ -0,0 +1,437 @@
+import os
+import mmap
+import errno
+import asyncio
+from ctypes import CDLL, Structure, memset, addressof, byref, sizeof, get_errno
+from ctypes import c_int, c_int32, c_long, c_uint8, c_uint16, c_uint32, c_uint64, c_voidp
+
+from .iocontext_base import IOContextBase
+from .iocontext_base import IO_CMD_PREAD, IO_CMD_PWRITE, IO_CMD_FSYNC, IO_CMD_FDSYNC
+from .iocontext_base import IO_CMD_NOOP, IO_CMD_PREADV, IO_CMD_PWRITEV
+from .iocontext_base import ioprio_values
+from .buffers import PinnedBuffer, IOVEC
+
+
+NR_io_uring_setup = 425
+NR_io_uring_enter = 426
+NR_io_uring_register = 427
+
+IORING_SETUP_CLAMP = 1 << 4
+IORING_FEAT_SINGLE_MMAP = 1 << 0
+
+IORING_OFF_SQ_RING = 0
+IORING_OFF_CQ_RING = 0x8000000
+IORING_OFF_SQES = 0x10000000
+
+IORING_REGISTER_BUFFERS = 0
+IORING_UNREGISTER_BUFFERS = 1
+IORING_REGISTER_FILES = 2
+IORING_UNREGISTER_FILES = 3
+IORING_REGISTER_EVENTFD = 4
+IORING_UNREGISTER_EVENTFD = 5
+IORING_REGISTER_FILES_UPDATE = 6
+
+IOSQE_FIXED_FILE = 1 << 0
+IOSQE_IO_DRAIN = 1 << 1
+IORING_FSYNC_DATASYNC = 1 << 0
+
+IORING_OP_NOP = 0
+IORING_OP_READV = 1
+IORING_OP_WRITEV = 2
+IORING_OP_FSYNC = 3
+IORING_OP_READ_FIXED = 4
+IORING_OP_WRITE_FIXED = 5
+IORING_OP_ASYNC_CANCEL = 14
+IORING_OP_READ = 22
+IORING_OP_WRITE = 23
+
+# user_data of cancel requests, whose completions are not reported
+CANCEL_TAG = 1 << 63
+
+# IO_CMD_* to IORING_OP_* and the fixed buffer variant, if any
+uring_ops = {
+    IO_CMD_PREAD: (IORING_OP_READ, IORING_OP_READ_FIXED),
+    IO_CMD_PWRITE: (IORING_OP_WRITE, IORING_OP_WRITE_FIXED),
+    IO_CMD_PREADV: (IORING_OP_READV, None),
+    IO_CMD_PWRITEV: (IORING_OP_WRITEV, None),
+    IO_CMD_FSYNC: (IORING_OP_FSYNC, None),
+    IO_CMD_FDSYNC: (IORING_OP_FSYNC, None),
+    IO_CMD_NOOP: (IORING_OP_NOP, None),
+}
+
+
+class IO_SQRING_OFFSETS(Structure):
+    _fields_ = [
+        ("head", c_uint32),
+        ("tail", c_uint32),
+        ("ring_mask", c_uint32),
+        ("ring_entries", c_uint32),
+        ("flags", c_uint32),
+        ("dropped", c_uint32),
+        ("array", c_uint32),
+        ("resv1", c_uint32),
+        ("user_addr", c_uint64),        # == 0x28
+        ]
+
+
+class IO_CQRING_OFFSETS(Structure):
+    _fields_ = [
+        ("head", c_uint32),
+        ("tail", c_uint32),
+        ("ring_mask", c_uint32),
+        ("ring_entries", c_uint32),
+        ("overflow", c_uint32),
+        ("cqes", c_uint32),
+        ("flags", c_uint32),
+        ("resv1", c_uint32),
+        ("user_addr", c_uint64),        # == 0x28
+        ]
+
+
+class IO_URING_PARAMS(Structure):
+    _fields_ = [
+        ("sq_entries", c_uint32),
+        ("cq_entries", c_uint32),
+        ("flags", c_uint32),
+        ("sq_thread_cpu", c_uint32),
+        ("sq_thread_idle", c_uint32),
+        ("features", c_uint32),
+        ("wq_fd", c_uint32),
+        ("resv", c_uint32 * 3),         # == 0x28
+        ("sq_off", IO_SQRING_OFFSETS),  # + 0x28
+        ("cq_off", IO_CQRING_OFFSETS),  # + 0x28 == 0x78
+        ]
+
+
+class IO_URING_SQE(Structure):
+    _fields_ = [
+        ("opcode", c_uint8),
+        ("flags", c_uint8),
+        ("ioprio", c_uint16),
+        ("fd", c_int32),
+        ("off", c_uint64),
+        ("addr", c_uint64),
+        ("len", c_uint32),
+        ("rw_flags", c_uint32),
+        ("user_data", c_uint64),        # == 0x28
+        ("buf_index", c_uint16),
+        ("personality", c_uint16),
+        ("splice_fd_in", c_int32),
+        ("addr3", c_uint64),
+        ("_pad2", c_uint64),            # == 0x40
+        ]
+
+
+class IO_URING_CQE(Structure):
+    _fields_ = [
+        ("user_data", c_uint64),
+        ("res", c_int32),
+        ("flags", c_uint32),            # == 0x10
+        ]
+
+
+class IO_URING_FILES_UPDATE(Structure):
+    _fields_ = [
+        ("offset", c_uint32),
+        ("resv", c_uint32),
+        ("fds", c_uint64),
+        ]
+
+
+libc = CDLL(None, use_errno=True)
+libc.syscall.restype = c_long
+
+
+def uring_syscall(nr, *args):
+    rc = libc.syscall(c_long(nr), *args)
+    return -get_errno() if rc < 0 else rc
+
+
+def uring_error(what, rc):
+    return OSError(-rc, f'{what}: {os.strerror(-rc)}')
+
+
+class IOContextUring(IOContextBase):
+    """IO context on an io_uring instance
+
+    Requests are written to the submission ring at flush time and submitted
+    with one io_uring_enter per batch. Completions are signalled on an
+    eventfd that is watched by the event loop and reaped from the
+    completion ring without a system call.
+    """
+
+    _fd = -1
+    _efd = -1
+
+    def __init__(self, numRequests=10000, **kw):
+        super().__init__(numRequests=numRequests, **kw)
+        params = IO_URING_PARAMS()
+        params.flags = IORING_SETUP_CLAMP
+        fd = uring_syscall(NR_io_uring_setup, c_uint32(min(numRequests, self._maxsubmit)), byref(params))
+        if fd < 0:
+            raise uring_error('io_uring_setup', fd)
+        self._fd = fd
+        self._params = params
+        # more completions than CQ entries would wait in the kernel overflow list
+        self.maxInflight = min(self.maxInflight, params.cq_entries)
+        self._map_rings(params)
+        self._prep = [None] * numRequests
+        self._fixedBuffers = []
+        self._fixedFiles = {}
+        self._loop = None
+        self._efd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        rc = uring_syscall(NR_io_uring_register, c_int(fd), c_uint32(IORING_REGISTER_EVENTFD),
+                           byref(c_int32(self._efd)), c_uint32(1))
+        if rc < 0:
+            self.closectx()
+            raise uring_error('io_uring_register', rc)
+
+    def _map_rings(self, params):
+        flags = mmap.MAP_SHARED | getattr(mmap, 'MAP_POPULATE', 0)
+        prot = mmap.PROT_READ | mmap.PROT_WRITE
+        sq, cq = params.sq_off, params.cq_off
+        sqsize = sq.array + params.sq_entries * sizeof(c_uint32)
+        cqsize = cq.cqes + params.cq_entries * sizeof(IO_URING_CQE)
+        if params.features & IORING_FEAT_SINGLE_MMAP:
+            self._sqmap = self._cqmap = mmap.mmap(self._fd, max(sqsize, cqsize), flags, prot,
+                                                  offset=IORING_OFF_SQ_RING)
+        else:
+            self._sqmap = mmap.mmap(self._fd, sqsize, flags, prot, offset=IORING_OFF_SQ_RING)
+            self._cqmap = mmap.mmap(self._fd, cqsize, flags, prot, offset=IORING_OFF_CQ_RING)
+        self._sqemap = mmap.mmap(self._fd, params.sq_entries * sizeof(IO_URING_SQE), flags, prot,
+                                 offset=IORING_OFF_SQES)
+
+        self._sqHead = c_uint32.from_buffer(self._sqmap, sq.head)
+        self._sqTail = c_uint32.from_buffer(self._sqmap, sq.tail)
+        self._sqMask = c_uint32.from_buffer(self._sqmap, sq.ring_mask).value
+        self._sqEntries = params.sq_entries
+        # SQE i always sits at ring index i
+        array = (c_uint32 * params.sq_entries).from_buffer(self._sqmap, sq.array)
+        array[:] = range(params.sq_entries)
+        self._sqes = (IO_URING_SQE * params.sq_entries).from_buffer(self._sqemap)
+
+        self._cqHead = c_uint32.from_buffer(self._cqmap, cq.head)
+        self._cqTail = c_uint32.from_buffer(self._cqmap, cq.tail)
+        self._cqMask = c_uint32.from_buffer(self._cqmap, cq.ring_mask).value
+        self._cqes = (IO_URING_CQE * params.cq_entries).from_buffer(self._cqmap, cq.cqes)
+
+    def __del__(self):
+        self.releaseThread()
+        self.closectx()
+        self.numRequests = -1
+
+    def closectx(self):
+        if self._efd >= 0:
+            os.close(self._efd)
+            self._efd = -1
+        if self._fd >= 0:
+            # the rings stay mapped until the views are collected
+            for p in self._fixedBuffers:
+                p.release()
+            self._fixedBuffers = []
+            self._fixedFiles = {}
+            os.close(self._fd)
+            self._fd = -1
+
+    def __repr__(self):
+        p = self._params
+        return f'IOContextUring({self._name}, n={self.numRequests}, sq={p.sq_entries}, cq={p.cq_entries})'
+
+    def _register(self, opcode, arg, nargs):
+        rc = uring_syscall(NR_io_uring_register, c_int(self._fd), c_uint32(opcode), arg, c_uint32(nargs))
+        if rc < 0:
+            raise uring_error('io_uring_register', rc)
+        return rc
+
+    def register_buffers(self, buffers):
+        """Register writable buffers for reads and writes without per request page pinning
+
+        Reads and writes falling inside a registered buffer use the fixed
+        buffer opcodes automatically.
+        """
+        self.unregister_buffers()
+        pinned = [PinnedBuffer(buf, writable=True) for buf in buffers]
+        iov = (IOVEC * len(pinned))(*[(p.address, p.nbytes) for p in pinned])
+        try:
+            self._register(IORING_REGISTER_BUFFERS, iov, len(pinned))
+        except OSError:
+            [p.release() for p in pinned]
+            raise
+        self._fixedBuffers = pinned
+
+    def unregister_buffers(self):
+        if self._fixedBuffers:
+            self._register(IORING_UNREGISTER_BUFFERS, None, 0)
+            [p.release() for p in self._fixedBuffers]
+            self._fixedBuffers = []
+
+    def register_files(self, fds):
+        """Register file descriptors to save the file lookup per request
+
+        The kernel holds a reference on the registered files until
+        unregister_files is called. An AIO releasing a registered file
+        drops it with file_closed, so that its reused fd is not mapped to
+        the old file; other fds must be unregistered before closing.
+        """
+        self.unregister_files()
+        fds = list(fds)
+        self._register(IORING_REGISTER_FILES, (c_int32 * len(fds))(*fds), len(fds))
+        self._fixedFiles = {fd: i for i, fd in enumerate(fds)}
+
+    def file_closed(self, fd):
+        index = self._fixedFiles.pop(fd, None)
+        if index is None:
+            return
+        fds = c_int32(-1)
+        try:
+            self._register(IORING_REGISTER_FILES_UPDATE, byref(IO_URING_FILES_UPDATE(index, 0, addressof(fds))), 1)
+        except OSError:
+            # before 5.5 the kernel keeps the file until unregister_files
+            pass
+
+    def unregister_files(self):
+        if self._fixedFiles:
+            self._register(IORING_UNREGISTER_FILES, None, 0)
+            self._fixedFiles = {}
+
+    def _fixed_buffer(self, address, nbytes):
+        for i, p in enumerate(self._fixedBuffers):
+            if p.address <= address and address + nbytes <= p.address + p.nbytes:
+                return i
+        return -1
+
+    def _io_fill(self, slot, op, fd, address, nbytes, offset, prio):
+        # the SQE is written at flush time, when its ring entry is known
+        self._prep[slot] = (op, fd, address, nbytes, offset, prio)
+
+    def _fill_sqe(self, sqe, slot):
+        op, fd, address, nbytes, offset, prio = self._prep[slot]
+        opcode, fixed_opcode = uring_ops[op]
+        memset(addressof(sqe), 0, sizeof(IO_URING_SQE))
+        if fixed_opcode is not None and self._fixedBuffers:
+            index = self._fixed_buffer(address, nbytes)
+            if index >= 0:
+                opcode = fixed_opcode
+                sqe.buf_index = index
+        sqe.opcode = opcode
+        sqe.ioprio = ioprio_values.get(prio, 0)
+        if op in (IO_CMD_PREAD, IO_CMD_PREADV) and self._writes and not self.nowait_ok(
+                fd, offset, self._readsDict[slot].nbytes):
+            # the ring does not order requests: a read of a range with a
+            # pending write waits for the requests submitted before it
+            sqe.flags = IOSQE_IO_DRAIN
+        index = self._fixedFiles.get(fd)
+        if index is not None:
+            sqe.flags |= IOSQE_FIXED_FILE
+            fd = index
+        sqe.fd = fd
+        sqe.off = offset
+        sqe.addr = address
+        sqe.len = nbytes
+        if op == IO_CMD_FDSYNC:
+            sqe.rw_flags = IORING_FSYNC_DATASYNC
+        sqe.user_data = slot
+
+    def flush_submit_queue(self):
+        # Write the queued requests to the SQ ring and submit them, as many
+        # per io_uring_enter call as there are free SQ entries
+        self._submitScheduled = False
+        queue = self._take_submit_queue()
+        sqes = self._sqes
+        mask = self._sqMask
+        nsubmitted = 0
+        nfailed = 0
+        pos = 0
+        while pos < len(queue):
+            head = self._sqHead.value
+            tail = self._sqTail.value
+            n = min(len(queue) - pos, self._maxsubmit, self._sqEntries - ((tail - head) & 0xffffffff))
+            for item in queue[pos:pos + n]:
+                self._fill_sqe(sqes[tail & mask], item.slot)
+                tail = (tail + 1) & 0xffffffff
+            self._sqTail.value = tail
+            rc = uring_syscall(NR_io_uring_enter, c_int(self._fd), c_uint32(n), c_uint32(0), c_uint32(0),
+                               c_voidp(None), c_long(0))
+            if rc <= 0:
+                # nothing consumed: take back the entries and fail the first
+                self._sqTail.value = self._sqHead.value
+                if rc == 0:
+                    self.log(f'io_uring_enter returned wrong code: {rc}')
+                    rc = -errno.EIO
+                self._io_submit_failed(queue[pos], rc, 'io_uring_enter')
+                nfailed += 1
+                pos += 1
+            else:
+                if rc < n:
+                    # partial submission: resubmit the rest
+                    self._sqTail.value = self._sqHead.value
+                self._stats.submit_batches.add(rc)
+                nsubmitted += rc
+                pos += rc
+        self._stats.submitted += nsubmitted
+        if nsubmitted > 0:
+            self._io_submit_handler(nsubmitted)
+        if nfailed > 0 and self._backlog:
+            asyncio.get_running_loop().call_soon(self.dispatch_backlog)
+
+    def _io_cancel(self, item):
+        head = self._sqHead.value
+        tail = self._sqTail.value
+        if (tail - head) & 0xffffffff >= self._sqEntries:
+            return
+        sqe = self._sqes[tail & self._sqMask]
+        memset(addressof(sqe), 0, sizeof(IO_URING_SQE))
+        sqe.opcode = IORING_OP_ASYNC_CANCEL
+        sqe.fd = -1
+        sqe.addr = item.slot
+        sqe.user_data = CANCEL_TAG | item.slot
+        self._sqTail.value = (tail + 1) & 0xffffffff
+        rc = uring_syscall(NR_io_uring_enter, c_int(self._fd), c_uint32(1), c_uint32(0), c_uint32(0),
+                           c_voidp(None), c_long(0))
+        if rc != 1:
+            self._sqTail.value = self._sqHead.value
+            self.log(f'Error io_uring_enter for cancel: {rc}')
+
+    def reap_events(self):
+        try:
+            os.eventfd_read(self._efd)
+        except BlockingIOError:
+            pass
+        cqes = self._cqes
+        mask = self._cqMask
+        head = self._cqHead.value
+        tail = self._cqTail.value
+        if head == tail:
+            return
+        evlist = []
+        while head != tail:
+            cqe = cqes[head & mask]
+            if not cqe.user_data & CANCEL_TAG:
+                evlist.append((cqe.user_data, cqe.res, 0))
+            head = (head + 1) & 0xffffffff
+        self._cqHead.value = head
+        if self._verbose:
+            self.log(f'reaped {len(evlist)} completions')
+        if evlist:
+            self.notify_cbcomplete_list(evlist)
+
+    async def start_aio_suspend_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self.releaseThread()
+            self._loop = loop
+            self._loop.add_reader(self._efd, self.reap_events)
+            if self._verbose:
+                self.log(f'eventfd {self._efd} reader added')
+
+    def releaseThread(self):
+        if self._loop is not None and not self._loop.is_closed() and self._efd >= 0:
+            self._loop.remove_reader(self._efd)
+            if self._verbose:
+                self.log(f'eventfd {self._efd} reader removed')
+        self._loop = None
+
+    async def release(self):
+        if self._verbose:
+            self.log(f'release')
+        self.releaseThread()
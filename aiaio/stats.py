@@ -0,0 +1,117 @@
+opnames = {0: 'pread', 1: 'pwrite', 2: 'fsync', 3: 'fdsync', 5: 'poll', 6: 'noop', 7: 'preadv', 8: 'pwritev'}
+
+read_ops = (0, 7)
+write_ops = (1, 8)
+
+
+class Histogram:
+    """Counts of non-negative integers in power of two buckets"""
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, v, n=1):
+        self.buckets[int(v).bit_length()] += n
+        self.count += n
+        self.total += v * n
+        if v > self.max:
+            self.max = v
+
+    def merge(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile"""
+        rank = self.count * p / 100
+        seen = 0
+        for i, c in enumerate(self.buckets):
+            seen += c
+            if c and seen >= rank:
+                return min((1 << i) - 1, self.max)
+        return self.max
+
+    def as_dict(self):
+        return dict(
+            count=self.count,
+            mean=self.total / self.count if self.count else 0,
+            max=self.max,
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+            p999=self.percentile(99.9),
+            buckets={(1 << i) - 1: c for i, c in enumerate(self.buckets) if c},
+        )
+
+
+class IOStats:
+    """Counters of an IO context, latencies are in microseconds"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.nowait_hits = 0
+        self.nowait_misses = 0
+        self.peak_inflight = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.submit_batches = Histogram()
+        self.reap_batches = Histogram()
+        self.latency = {}
+
+    def complete(self, op, res, t0, t1):
+        self.completed += 1
+        if res < 0:
+            self.failed += 1
+        elif op in read_ops:
+            self.bytes_read += res
+        elif op in write_ops:
+            self.bytes_written += res
+        hist = self.latency.get(op)
+        if hist is None:
+            hist = self.latency[op] = Histogram()
+        hist.add(int((t1 - t0) * 1e6))
+
+    def merge(self, other):
+        self.submitted += other.submitted
+        self.completed += other.completed
+        self.failed += other.failed
+        self.cancelled += other.cancelled
+        self.nowait_hits += other.nowait_hits
+        self.nowait_misses += other.nowait_misses
+        # the peaks of merged contexts need not coincide, their sum is no peak
+        self.peak_inflight = max(self.peak_inflight, other.peak_inflight)
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.submit_batches.merge(other.submit_batches)
+        self.reap_batches.merge(other.reap_batches)
+        for op, hist in other.latency.items():
+            self.latency.setdefault(op, Histogram()).merge(hist)
+
+    def as_dict(self, inflight=0):
+        return dict(
+            submitted=self.submitted,
+            completed=self.completed,
+            failed=self.failed,
+            cancelled=self.cancelled,
+            nowait_hits=self.nowait_hits,
+            nowait_misses=self.nowait_misses,
+            inflight=inflight,
+            peak_inflight=self.peak_inflight,
+            bytes_read=self.bytes_read,
+            bytes_written=self.bytes_written,
+            submit_batches=self.submit_batches.as_dict(),
+            reap_batches=self.reap_batches.as_dict(),
+            latency_us={opnames.get(op, str(op)): hist.as_dict() for op, hist in self.latency.items()},
+        )
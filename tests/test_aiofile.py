@@ -7,12 +7,21 @@ import sys
 import uuid
 import json
 import binascii
+import mmap
 
 sys.path = ['.'] + sys.path
 
-from aiaio import AIOFile, LineReader, IOContext
+from aiaio import AIOFile, LineReader, IOContext, IOContextEventFD, IOContextPool, IOContextUring
+from aiaio import IOContextThreadPool, PRIO_LATENCY, PRIO_BACKGROUND
 from aiaio import aio as aiomodule
 from aiaio.aiaio import aenumerate
+from aiaio import aiaio as aiaiomodule
+from aiaio import bench
+from aiaio.buffers import AlignedBufferPool
+from aiaio.cache import BlockCache
+
+
+needs_libaio = pytest.mark.skipif(aiomodule.libaio is None, reason='libaio not found')
 
 
 # cf. https://stackoverflow.com/questions/77242992/pytest-asyncio-howto-await-in-setup-and-teardown
@@ -179,6 +188,134 @@ class TestCases1():
                 if i == 100:
                     assert line == b'Incomplete'
 
+    @pytest.mark.parametrize('chunksize,readahead', [(7, 1), (7, 5), (64, 3), (1 << 16, 4)])
+    async def test_aiofile09a(self, chunksize, readahead):
+        lines = [ binascii.b2a_base64(os.urandom(i % 40)) for i in range(200) ] + [b'Incomplete \xc3\xa4']
+        async with AIOFile('example3.txt', 'w+') as aio:
+            await aio.write(b''.join(lines))
+            lread = LineReader(aio, chunksize=chunksize, readahead=readahead)
+            result = [line async for line in lread]
+            assert result == lines
+            batches = [batch async for batch in LineReader(aio, chunksize=chunksize).batches()]
+            assert sum(batches, []) == lines
+        async with AIOFile('example3.txt', 'r', encoding='utf8') as aio:
+            result = [line async for line in LineReader(aio, chunksize=chunksize, readahead=readahead)]
+            assert result == [line.decode('utf8') for line in lines]
+        os.unlink('example3.txt')
+
+    async def test_aiofile09b(self):
+        data = os.urandom(100000)
+        async with AIOFile('example3.txt', 'w+') as aio:
+            await aio.write(data)
+            chunks = [chunk async for chunk in aio.stream(4096, depth=3)]
+            assert len(chunks) == 25 and b''.join(chunks) == data
+            chunks = [chunk async for chunk in aio.stream(1000, depth=8, start=500, end=10100)]
+            assert b''.join(chunks) == data[500:10100]
+            chunks = [bytes(chunk) async for chunk in aio.stream(4096, depth=3, recycle=True)]
+            assert b''.join(chunks) == data
+            async for chunk in aio.stream(4096, depth=3):
+                break
+        async with AIOFile('example3.txt', 'w+', encoding='utf8') as aio:
+            text = 'Testä Testb ü' * 1000
+            await aio.write(text)
+            chunks = [chunk async for chunk in aio.stream(999, depth=2)]
+            assert ''.join(chunks) == text
+        pool = AlignedBufferPool()
+        async with AIOFile('example3.txt', 'r+', direct=True, buffer_pool=pool) as aio:
+            chunks = [bytes(chunk) async for chunk in aio.stream(1 << 13, depth=2, recycle=True)]
+            assert b''.join(chunks) == text.encode('utf8')
+            # the buffers return to the pool, also when the stream is closed early
+            assert len(pool._free[1 << 13]) == 2
+            stream = aio.stream(1 << 13, depth=4, recycle=True)
+            async for chunk in stream:
+                del chunk
+                break
+            await stream.aclose()
+            assert len(pool._free[1 << 13]) == 4
+        os.unlink('example3.txt')
+
+    @pytest.mark.parametrize('direct', [False, True])
+    async def test_aiofile09c(self, direct):
+        lines = [ binascii.b2a_base64(os.urandom(i % 150)) for i in range(20000) ]
+        async with AIOFile('example3.txt', 'w+', direct=direct) as aio:
+            async with aio.writer(bufsize=1 << 14, depth=3) as writer:
+                for l in lines:
+                    await writer.write(l)
+                assert writer.offset + len(writer._buf) == sum(len(l) for l in lines)
+            writer = aio.writer()
+            assert writer.offset == os.path.getsize('example3.txt')
+            await writer.write(b'Incomplete')
+            await writer.drain()
+            result = [line async for line in LineReader(aio)]
+            assert result == lines + [b'Incomplete']
+        # failed writes are all retrieved, none is left running
+        async with AIOFile('example3.txt', 'r', direct=direct) as aio:
+            writer = aio.writer(bufsize=1 << 12, depth=4)
+            with pytest.raises(OSError):
+                async with writer:
+                    for l in lines[0:1000]:
+                        await writer.write(l)
+            assert not writer._pending
+        os.unlink('example3.txt')
+
+    @pytest.mark.parametrize('opts', [[], ['--no-copy-range'], ['-d', '-b', '4k', '-q', '4']])
+    async def test_aiofile09d(self, opts):
+        data = os.urandom(100000)
+        with open('example3.txt', 'wb') as f:
+            f.write(data)
+        args = aiaiomodule.mkparser().parse_args(['example3.txt', 'example3.txt', '-o', 'example4.txt'] + opts)
+        await aiaiomodule.arun(args)
+        with open('example4.txt', 'rb') as f:
+            assert f.read() == data + data
+        args = aiaiomodule.mkparser().parse_args(['example3.txt', '-a', '-o', 'example4.txt'] + opts)
+        await aiaiomodule.arun(args)
+        with open('example4.txt', 'rb') as f:
+            assert f.read() == data + data + data
+        for append in [[], ['-a']]:
+            args = aiaiomodule.mkparser().parse_args(['example4.txt', 'example3.txt', '-o', 'example3.txt'] + append)
+            with pytest.raises(ValueError):
+                await aiaiomodule.arun(args)
+            assert os.path.getsize('example3.txt') == len(data)
+        os.unlink('example3.txt')
+        os.unlink('example4.txt')
+
+    async def test_aiofile09e(self):
+        args = bench.mkparser().parse_args(['-f', 'example3.txt', '-S', '1M', '-w', 'read,randrw',
+                                            '-b', '4k,16k', '-q', '1,4', '-n', '100', '-j', 'example4.json'])
+        results = await bench.arun(args)
+        # sync runs at the first queue depth only
+        available = [engine for engine in bench.engines if await bench.available(engine)]
+        assert len(results) == 2 * 2 * (2 * (len(available) - 1) + 1)
+        assert all(r['requests'] == 100 and r['iops'] > 0 for r in results)
+        with open('example4.json') as f:
+            assert json.load(f)['results'] == results
+        assert not os.path.exists('example3.txt')
+        os.unlink('example4.json')
+
+    async def test_aiofile09f(self, monkeypatch):
+        def broken(*args, **kw):
+            raise OSError(38, 'not available')
+        monkeypatch.setitem(bench.contexts, 'broken', broken)
+        monkeypatch.setattr(bench, 'engines', bench.engines + ['broken'])
+        data = os.urandom(1 << 16)
+        with open('example3.txt', 'wb') as f:
+            f.write(data)
+
+        def args(*opts):
+            return bench.mkparser().parse_args(['-f', 'example3.txt', '-n', '10', '-q', '1', *opts])
+        # an existing file is neither overwritten nor deleted
+        with pytest.raises(ValueError):
+            await bench.arun(args('-S', '1M'))
+        with pytest.raises(ValueError):
+            await bench.arun(args('-S', '64k', '-w', 'randwrite'))
+        results = await bench.arun(args('-S', '64k', '-w', 'randread', '-E', 'sync,broken'))
+        assert [r['engine'] for r in results] == ['sync']
+        with open('example3.txt', 'rb') as f:
+            assert f.read() == data
+        await bench.arun(args('-S', '64k', '-w', 'randwrite', '-E', 'sync', '--force'))
+        assert os.path.getsize('example3.txt') == 1 << 16
+        os.unlink('example3.txt')
+
     async def test_aiofile10(self):
         async with AIOFile('example1.txt', 'r+') as aio:
             await aio.fsync()
@@ -186,6 +323,75 @@ class TestCases1():
             await aio.fsync()
             await aio.truncate()
 
+    async def test_aiofile11(self):
+        data = os.urandom(1 << 16)
+        async with AIOFile('example3.txt', 'w+') as aio:
+            await aio.write(data)
+            buf = bytearray(1 << 12)
+            n = await aio.readinto(buf, offset=100)
+            assert n == len(buf) and buf == data[100:100 + n]
+            buf = bytearray(1 << 12)
+            n = await aio.readinto(memoryview(buf)[10:20], offset=0)
+            assert n == 10 and buf[10:20] == data[0:10] and buf[0:10] == bytes(10)
+            with mmap.mmap(-1, 1 << 17) as mm:
+                n = await aio.readinto(mm, offset=0)
+                assert n == len(data) and mm[0:n] == data
+            with pytest.raises(BufferError):
+                await aio.readinto(b'readonly')
+        os.unlink('example3.txt')
+
+    async def test_aiofile12(self):
+        data = os.urandom(1 << 16)
+        async with AIOFile('example3.txt', 'w+') as aio:
+            n = await aio.write(memoryview(data)[1000:2000], offset=0)
+            assert n == 1000
+            n = await aio.write(bytearray(data[0:10]), offset=1000)
+            assert n == 10
+            with mmap.mmap(-1, 100) as mm:
+                mm[0:100] = data[-100:]
+                n = await aio.write(mm, offset=1010)
+                assert n == 100
+            assert await aio.read(1110) == data[1000:2000] + data[0:10] + data[-100:]
+        async with AIOFile('example3.txt', 'r+', encoding='utf8') as aio:
+            await aio.write('Testa ', offset=0)
+            await aio.write(b'Testb', offset=6)
+            assert await aio.read(11) == 'Testa Testb'
+        os.unlink('example3.txt')
+
+    async def test_aiofile13(self):
+        data = os.urandom(1 << 16)
+        async with AIOFile('example3.txt', 'w+', direct=True) as aio:
+            buf = mmap.mmap(-1, 1 << 13)
+            buf[:] = data[0:1 << 13]
+            assert await aio.write(buf, offset=0) == 1 << 13
+            assert await aio.write(data[100:1000], offset=100) == 900
+            assert await aio.write(data[5000:12000], offset=5000) == 7000
+            assert await aio.write(data[12000:12001], offset=12000) == 1
+            assert os.path.getsize('example3.txt') == 12001
+            tasks = [aio.write(data[i:i+100], offset=i) for i in range(12001, 20001, 100)]
+            await asyncio.gather(*tasks)
+            assert os.path.getsize('example3.txt') == 20001
+            assert await aio.read(20001) == data[0:20001]
+            assert await aio.read(50, offset=19990) == data[19990:20001]
+            buf = bytearray(333)
+            assert await aio.readinto(buf, offset=4000) == 333
+            assert buf == data[4000:4333]
+        os.unlink('example3.txt')
+
+    async def test_aiofile14(self):
+        header, payload, trailer = b'HEAD', os.urandom(1000), b'TAIL\n'
+        for direct in [False, True]:
+            async with AIOFile('example3.txt', 'w+', direct=direct) as aio:
+                n = await aio.writev([header, payload, trailer], offset=10)
+                assert n == len(header) + len(payload) + len(trailer)
+                bufs = [bytearray(4), bytearray(1000), bytearray(5)]
+                assert await aio.readv(bufs, offset=10) == n
+                assert bufs == [header, payload, trailer]
+                bufs = [bytearray(4), bytearray(2000)]
+                assert await aio.readv(bufs, offset=1010) == 9
+                assert bufs[0] == payload[-4:] and bufs[1][0:5] == trailer
+            os.unlink('example3.txt')
+
 
 @pytest.mark.asyncio(loop_scope="class")
 class TestCases2:
@@ -207,6 +413,7 @@ class TestCases2:
             tasks = [ aio.write(i.to_bytes(4) + data, offset=19 + (i+1)*len(data)) for i in range(50) ]
             results = await asyncio.gather(*tasks)
 
+    @needs_libaio
     async def test_aiofile02(self):
         async with IOContext(10000, name='Testctx1') as ioctx:
             filenames = [f'example{i:02d}.txt' for i in range(100)]
@@ -225,6 +432,7 @@ class TestCases2:
 
             [os.unlink(fn) for fn in filenames]
 
+    @needs_libaio
     async def test_aiofile03(self):
         filenames = [f'example{i:02d}.txt' for i in range(100)]
         ioctx = [IOContext(15) for fname in filenames]
@@ -244,6 +452,414 @@ class TestCases2:
 
         [os.unlink(fn) for fn in filenames]
 
+    @needs_libaio
+    async def test_aiofile04(self):
+        async with IOContext(10000, name='Testctx2', maxSubmit=64) as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx) as aio:
+                data = b'Testa Testb testc\r\n'
+                tasks = [ aio.write(i.to_bytes(4) + data, offset=i*(4+len(data))) for i in range(5000) ]
+                results = await asyncio.gather(*tasks)
+                assert results == [4+len(data)]*5000
+                tasks = [ aio.read(4, offset=i*(4+len(data))) for i in range(5000) ]
+                results = await asyncio.gather(*tasks)
+                for i in range(len(results)):
+                    assert int().from_bytes(results[i]) == i
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    async def test_aiofile05(self):
+        async with IOContextEventFD(10000, name='Testctx3') as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx) as aio:
+                data = b'Testa Testb testc\r\n'
+                tasks = [ aio.write(i.to_bytes(4) + data, offset=i*(4+len(data))) for i in range(5000) ]
+                await asyncio.gather(*tasks)
+                await aio.fsync()
+                tasks = [ aio.read(4, offset=i*(4+len(data))) for i in range(5000) ]
+                results = await asyncio.gather(*tasks)
+                for i in range(len(results)):
+                    assert int().from_bytes(results[i]) == i
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    async def test_aiofile06(self):
+        data = os.urandom(1 << 16)
+        pool = AlignedBufferPool()
+        pool.preallocate(1 << 12, 16)
+        async with IOContext(16, name='Testctx4', buffers=pool) as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx, direct=True) as aio:
+                for i in range(0, len(data), 1 << 12):
+                    await aio.write(data[i:i + (1 << 12)], offset=i)
+                for k in range(100):
+                    tasks = [aio.read(100, offset=k*16 + i*100) for i in range(16)]
+                    results = await asyncio.gather(*tasks)
+                    assert b''.join(results) == data[k*16:k*16 + 1600]
+                tasks = [aio.read(100, offset=i*100) for i in range(600)]
+                results = await asyncio.gather(*tasks)
+                assert b''.join(results) == data[0:60000]
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    async def test_aiofile07(self):
+        data = os.urandom(1 << 20)
+        async with IOContext(8, name='Testctx5', maxInflight=4, maxInflightBytes=1 << 16) as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx, nowait=False) as aio:
+                tasks = [aio.write(data[i:i + (1 << 14)], offset=i) for i in range(0, len(data), 1 << 14)]
+                await asyncio.gather(*tasks)
+                tasks = [aio.read(1 << 15, offset=i) for i in range(0, len(data), 1 << 15)]
+                tasks += [aio.read(1 << 17, offset=0)]
+                tasks = [asyncio.ensure_future(t) for t in tasks]
+                await asyncio.sleep(0)
+                # reads waiting for admission have no buffer yet
+                waiting = [entry[0] for finish, seq, entry in ioctx._backlog._heap]
+                assert len(waiting) == 33 - 2 and all(item.buf is None for item in waiting)
+                results = await asyncio.gather(*tasks)
+                assert b''.join(results[:-1]) == data and results[-1] == data[0:1 << 17]
+                assert ioctx._inflight == 0 and ioctx._inflightBytes == 0
+                stats = ioctx.stats()
+                assert stats['submitted'] == stats['completed'] == 64 + 33
+                assert stats['failed'] == 0 and stats['inflight'] == 0 and stats['peak_inflight'] == 4
+                assert stats['bytes_written'] == len(data)
+                assert stats['bytes_read'] == len(data) + (1 << 17)
+                assert stats['latency_us']['pwrite']['count'] == 64
+                assert stats['latency_us']['pread']['count'] == 33
+                assert stats['submit_batches']['max'] <= 4
+                assert sum(stats['reap_batches']['buckets'].values()) == stats['reap_batches']['count']
+                ioctx.reset_stats()
+                assert ioctx.stats()['submitted'] == 0
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    async def test_aiofile07a(self):
+        data = b'Testa Testb testc\r\n'
+        async with IOContext(1000, name='Testctx6', submitThread=True) as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx) as aio:
+                tasks = [aio.write(i.to_bytes(4) + data, offset=i*(4+len(data))) for i in range(5000)]
+                assert await asyncio.gather(*tasks) == [4+len(data)]*5000
+                tasks = [aio.read(4, offset=i*(4+len(data))) for i in range(5000)]
+                results = await asyncio.gather(*tasks)
+                assert [int().from_bytes(r) for r in results] == list(range(5000))
+                with pytest.raises(OSError):
+                    await ioctx._io_submit(0, -1)
+                assert ioctx._inflight == 0 and len(ioctx._freeSlots) == 1000
+                stats = ioctx.stats()
+                assert stats['failed'] == 1 and stats['submitted'] == stats['completed']
+        assert ioctx._submitter is None
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    async def test_aiofile07b(self):
+        data = os.urandom(1 << 16)
+        done = []
+        async with IOContext(64, name='Testctx7', maxInflight=2) as ioctx:
+            async with AIOFile('example4.txt', 'w+', io_context=ioctx, priority=PRIO_BACKGROUND, nowait=False) as scan, \
+                       AIOFile('example5.txt', 'w+', io_context=ioctx, nowait=False) as fg:
+                await scan.write(data)
+                await fg.write(data, priority=PRIO_LATENCY)
+
+                async def read(f, name, i, priority=None):
+                    assert await f.read(4096, offset=i * 4096, priority=priority) == data[i*4096:(i+1)*4096]
+                    done.append(name)
+
+                tasks = [asyncio.ensure_future(read(scan, 'bg', i % 16)) for i in range(100)]
+                await asyncio.sleep(0)
+                tasks += [asyncio.ensure_future(read(fg, 'fg', i, PRIO_LATENCY)) for i in range(16)]
+                await asyncio.gather(*tasks)
+                # foreground reads overtake the backlog of the scan
+                assert max(i for i, name in enumerate(done) if name == 'fg') < 40
+                assert ioctx.stats()['failed'] == 0
+        os.unlink('example4.txt')
+        os.unlink('example5.txt')
+
+    @pytest.mark.parametrize('context', [pytest.param(IOContext, marks=needs_libaio),
+                                         IOContextUring, IOContextThreadPool])
+    async def test_aiofile07c(self, context):
+        data = os.urandom(1 << 16)
+        async with context(32, name='Testctx8', maxInflight=4) as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx, nowait=False) as aio:
+                await aio.write(data)
+                tasks = [asyncio.ensure_future(aio.read(4096, offset=i % 16 * 4096)) for i in range(100)]
+                await asyncio.sleep(0)
+                [t.cancel() for t in tasks[2:]]
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                assert results[0:2] == [data[0:4096], data[4096:8192]]
+                while ioctx._inflight:
+                    await asyncio.sleep(1e-3)
+                assert len(ioctx._freeSlots) == 32 and not ioctx._readsDict and not ioctx._backlog
+                assert ioctx.stats()['cancelled'] == 98
+                assert await aio.read(4096, offset=4096, timeout=10) == data[4096:8192]
+        os.unlink('example3.txt')
+
+    async def test_aiofile07d(self):
+        r, w = os.pipe()
+        try:
+            async with IOContextUring(8, name='Testuring3') as ioctx:
+                async with AIOFile(f'/dev/fd/{r}', 'rb', io_context=ioctx) as aio:
+                    # a read of an empty pipe blocks until it is cancelled in the kernel
+                    with pytest.raises(TimeoutError):
+                        await aio.read(5, timeout=0.05)
+                    while ioctx._readsDict:
+                        await asyncio.sleep(1e-3)
+                    assert len(ioctx._freeSlots) == 8 and ioctx.stats()['cancelled'] == 1
+                    os.write(w, b'hello')
+                    assert await aio.read(5, timeout=10) == b'hello'
+        finally:
+            os.close(r)
+            os.close(w)
+
+    @needs_libaio
+    async def test_aiofile07e(self):
+        data = os.urandom(1 << 16)
+        async with IOContext(64, name='Testctx9', pollWindow=1e-3, pollCpu=min(os.sched_getaffinity(0))) as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx) as aio:
+                await aio.write(data)
+                for i in range(200):
+                    assert await aio.read(4096, offset=i % 16 * 4096) == data[i % 16 * 4096:(i % 16 + 1) * 4096]
+                stats = ioctx.stats()
+                assert stats['poll']['hits'] > 0
+                assert 0 <= stats['poll']['window_us'] <= 1000
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    @pytest.mark.parametrize('context', [IOContext, IOContextEventFD])
+    @pytest.mark.parametrize('ringReap', [True, False])
+    async def test_aiofile07f(self, context, ringReap):
+        data = os.urandom(1 << 16)
+        async with context(16, name='Testctx10', ringReap=ringReap) as ioctx:
+            assert (ioctx._ring is not None) == ringReap
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx) as aio:
+                await aio.write(data)
+                # many times the ring size, so that the ring head wraps around
+                tasks = [aio.read(16, offset=i * 16) for i in range(4096)]
+                assert b''.join(await asyncio.gather(*tasks)) == data
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    async def test_aiofile07g(self):
+        data = os.urandom(1 << 20)
+        async with IOContext(64, name='Testctx11') as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx) as aio:
+                await aio.write(data)
+                await aio.fsync()
+                os.posix_fadvise(aio.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                submitted = ioctx.stats()['submitted']
+                # not cached: falls back to the asynchronous read
+                assert await aio.read(4096, offset=1 << 19) == data[1 << 19:(1 << 19) + 4096]
+                stats = ioctx.stats()
+                assert stats['nowait_misses'] + stats['nowait_hits'] == 1
+                assert stats['submitted'] == submitted + stats['nowait_misses']
+                assert await aio.read(100, offset=len(data) - 50) == data[-50:]
+                # cached: served inline without a request
+                submitted = ioctx.stats()['submitted']
+                buf = bytearray(4096)
+                for i in range(10):
+                    assert await aio.readinto(buf, offset=1 << 19) == 4096 and buf == data[1 << 19:(1 << 19) + 4096]
+                assert await aio.read(100, offset=len(data) - 50) == data[-50:]
+                stats = ioctx.stats()
+                assert stats['nowait_hits'] >= 11 and stats['submitted'] == submitted
+        os.unlink('example3.txt')
+
+    @pytest.mark.parametrize('context', [None, pytest.param(IOContext, marks=needs_libaio),
+                                         IOContextUring, IOContextThreadPool])
+    async def test_aiofile07g1(self, context):
+        ioctx = context(64, name='Testctx14') if context is not None else None
+        async with AIOFile('example3.txt', 'w+b', io_context=ioctx) as aio:
+            await aio.write(b'A' * 8192)
+            assert await aio.read(4096) == b'A' * 4096
+            # a cached read does not overtake an earlier overlapping write
+            for i in range(20):
+                data = bytes([66 + i]) * 4096
+                res = await asyncio.gather(aio.write(data, offset=i * 8), aio.read(4096, offset=i * 8 + 100))
+                assert res[1] == data[100:] + b'A' * 100
+            assert not aio._file.ctx._writes
+        if ioctx is not None:
+            await ioctx.release()
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    @pytest.mark.parametrize('direct', [False, True])
+    async def test_aiofile07h(self, direct):
+        data = os.urandom((1 << 16) + 100)
+        cache = BlockCache(maxBytes=1 << 15, blockSize=1 << 12)
+        async with IOContext(64, name='Testctx12', cache=cache) as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx, direct=direct, nowait=False) as aio:
+                await aio.write(data)
+                # concurrent reads of a block share one request
+                tasks = [aio.read(100, offset=i * 40) for i in range(50)]
+                assert await asyncio.gather(*tasks) == [data[i * 40:i * 40 + 100] for i in range(50)]
+                stats = ioctx.stats()['cache']
+                assert stats['misses'] == 1 and stats['shared'] == 49 and stats['blocks'] == 1
+                submitted = ioctx.stats()['submitted']
+                buf = bytearray(5000)
+                for i in range(10):
+                    assert await aio.readinto(buf, offset=100) == 5000 and buf == data[100:5100]
+                stats = ioctx.stats()
+                assert stats['submitted'] == submitted + 1 and stats['cache']['hits'] >= 19
+                # writes invalidate the overlapping blocks
+                await aio.write(b'x' * 10, offset=4090)
+                assert await aio.read(20, offset=4085) == data[4085:4090] + b'x' * 10 + data[4100:4105]
+                assert ioctx.stats()['cache']['invalidations'] == 2
+                # the short last block is not cached
+                assert await aio.read(200, offset=1 << 16) == data[1 << 16:]
+                assert await aio.read(200, offset=1 << 16) == data[1 << 16:]
+                assert ioctx.stats()['cache']['blocks'] == 2
+                async with AIOFile('example3.txt', 'r', io_context=ioctx, direct=direct) as aio2:
+                    assert await aio2.read(20, offset=4085) == data[4085:4090] + b'x' * 10 + data[4100:4105]
+                    assert ioctx.stats()['cache']['hits'] >= 21
+                chunks = [chunk async for chunk in aio.stream(1 << 12)]
+                assert b''.join(chunks)[4090:4100] == b'x' * 10 and ioctx.stats()['cache']['blocks'] == 2
+                tasks = [aio.read(1 << 12, offset=i << 12) for i in range(16)]
+                assert b''.join(await asyncio.gather(*tasks))[4090:4100] == b'x' * 10
+                stats = ioctx.stats()['cache']
+                assert stats['blocks'] == 8 and stats['bytes'] == 1 << 15 and stats['evictions'] == 8
+                await aio.truncate(100)
+                assert await aio.read(200) == data[0:100] and ioctx.stats()['cache']['blocks'] == 0
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    async def test_aiofile07i(self):
+        cache = BlockCache(maxBytes=1 << 20, blockSize=1 << 12)
+        async with IOContext(64, name='Testctx13', cache=cache) as ioctx:
+            async with AIOFile('example3.txt', 'w+b', io_context=ioctx, nowait=False) as aio:
+                await aio.write(b'A' * 8192)
+                assert await aio.read(4096) == b'A' * 4096
+                # reopening with truncation drops the blocks of the open file
+                async with AIOFile('example3.txt', 'w+b', io_context=ioctx) as aio2:
+                    assert await aio2.read(4096) == b''
+                    await aio2.write(b'B' * 8192)
+                    assert await aio.read(4096) == b'B' * 4096
+                assert cache.stats()['blocks'] == 1
+            # the last close drops them, a new file may reuse the inode
+            assert cache.stats()['blocks'] == 0
+            os.unlink('example3.txt')
+            for i in range(4):
+                async with AIOFile('example3.txt', 'w+b', io_context=ioctx) as aio:
+                    await aio.write(bytes([67 + i]) * 8192)
+                    assert await aio.read(4096) == bytes([67 + i]) * 4096
+                os.unlink('example3.txt')
+            # large writes visit the cached blocks instead of the whole range
+            async with AIOFile('example3.txt', 'w+b', io_context=ioctx) as aio:
+                await aio.write(b'D' * 8192)
+                assert await aio.read(8192) == b'D' * 8192
+                cache.invalidate(aio._file._key, 0, 1 << 40)
+                assert cache.stats()['blocks'] == 0
+        os.unlink('example3.txt')
+
+    @needs_libaio
+    @pytest.mark.parametrize('spread', ['file', 'roundrobin'])
+    async def test_aiofile08(self, spread):
+        async with IOContextPool(4, 1000, name='Testpool1', spread=spread) as ioctx:
+            filenames = [f'example{i:02d}.txt' for i in range(20)]
+            files = [AIOFile(fname, 'w+', io_context=ioctx, nowait=False) for fname in filenames]
+
+            async with asyncio.TaskGroup() as tg:
+                [tg.create_task(f.open()) for f in files]
+
+            data = os.urandom(1 << 7)
+            async with asyncio.TaskGroup() as tg:
+                for count in range(50):
+                    [tg.create_task(f.write(data, offset=(1<<7)*count)) for f in files]
+
+            reads = [f.read(1 << 7, offset=(1<<7)*count) for count in range(50) for f in files]
+            results = await asyncio.gather(*reads)
+            assert results == [data] * len(reads)
+            stats = ioctx.stats()
+            assert stats['completed'] == 2000 and stats['bytes_read'] == 1000 * (1 << 7)
+            assert stats['peak_shard_inflight'] == max(ctx._stats.peak_inflight for ctx in ioctx.shards)
+
+            async with asyncio.TaskGroup() as tg:
+                [tg.create_task(f.close()) for f in files]
+
+            [os.unlink(fn) for fn in filenames]
+
+    @needs_libaio
+    async def test_aiofile08a(self):
+        async with IOContextPool() as ioctx:
+            assert len(ioctx.shards) == os.cpu_count() and ioctx.numRequests < 10000 + os.cpu_count()
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx) as aio:
+                await aio.write(b'Testa Testb testc\r\n')
+                assert await aio.read(5) == b'Testa'
+        os.unlink('example3.txt')
+
+    @pytest.mark.parametrize('direct', [False, True])
+    async def test_aiofile09(self, direct):
+        data = os.urandom(1 << 16)
+        async with IOContextUring(10000, name='Testuring1') as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx, direct=direct) as aio:
+                tasks = [aio.write(data[i:i + 4096], offset=i) for i in range(0, len(data), 4096)]
+                assert await asyncio.gather(*tasks) == [4096] * 16
+                await aio.fsync()
+                await aio.fdsync()
+                tasks = [aio.read(100, offset=i*100) for i in range(600)]
+                assert b''.join(await asyncio.gather(*tasks)) == data[0:60000]
+                bufs = [bytearray(10), bytearray(20)]
+                assert await aio.readv(bufs, offset=5) == 30
+                assert bytes(bufs[0] + bufs[1]) == data[5:35]
+                stats = ioctx.stats()
+                assert stats['failed'] == 0 and stats['inflight'] == 0
+        os.unlink('example3.txt')
+
+    async def test_aiofile10(self):
+        data = os.urandom(1 << 14)
+        async with IOContextUring(64, name='Testuring2') as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx) as aio:
+                fixed = mmap.mmap(-1, 1 << 14)
+                ioctx.register_buffers([fixed])
+                ioctx.register_files([aio.fileno()])
+                mv = memoryview(fixed)
+                mv[:] = data
+                assert await aio.write(mv[0:1 << 13], offset=0) == 1 << 13
+                assert await aio.write(data[1 << 13:], offset=1 << 13) == 1 << 13
+                mv[:] = bytes(1 << 14)
+                assert await aio.readinto(mv[100:1100], offset=100) == 1000
+                assert mv[100:1100] == data[100:1100]
+                assert await aio.read(1 << 15) == data
+                ioctx.unregister_files()
+                ioctx.unregister_buffers()
+                mv.release()
+                fixed.close()
+                with pytest.raises(OSError):
+                    await ioctx._io_submit(0, -1)
+            # a registered fd reused by another file no longer maps to the closed one
+            async with AIOFile('example3.txt', 'r+b', io_context=ioctx) as aio:
+                fd = aio.fileno()
+                ioctx.register_files([fd])
+            async with AIOFile('example4.txt', 'w+b', io_context=ioctx) as aio:
+                assert aio.fileno() == fd
+                await aio.write(b'x' * 100)
+                assert await aio.read(200) == b'x' * 100
+            with open('example3.txt', 'rb') as f:
+                assert f.read() == data
+            ioctx.unregister_files()
+        os.unlink('example3.txt')
+        os.unlink('example4.txt')
+
+    async def test_aiofile11(self):
+        data = b'Testa Testb testc\r\n'
+        async with IOContextThreadPool(10000, name='Testthreads1', numThreads=8) as ioctx:
+            async with AIOFile('example3.txt', 'w+', io_context=ioctx) as aio:
+                # overlapping writes take effect in submission order
+                tasks = [aio.write(i.to_bytes(4) + data, offset=i*len(data)) for i in range(2000)]
+                await asyncio.gather(*tasks)
+                tasks = [aio.fsync()] + [aio.read(4, offset=i*len(data)) for i in range(2000)]
+                results = await asyncio.gather(*tasks)
+                assert [int().from_bytes(r) for r in results[1:]] == list(range(2000))
+                bufs = [bytearray(4), bytearray(), bytearray(len(data))]
+                assert await aio.readv(bufs, offset=0) == 4 + len(data)
+                assert bufs[0] == bytes(4) and bufs[2] == data[0:15] + (1).to_bytes(4)
+                assert ioctx._files == {} and ioctx._blocked == {} and ioctx._dependents == {}
+                # requests waiting behind others complete after a release
+                block = os.urandom(1 << 20)
+                tasks = [asyncio.ensure_future(aio.write(block, offset=i << 10)) for i in range(4)]
+                while not ioctx._blocked:
+                    await asyncio.sleep(0)
+                await ioctx.release()
+                assert await asyncio.wait_for(asyncio.gather(*tasks), 10) == [1 << 20] * 4
+                assert ioctx._executor is None
+        os.unlink('example3.txt')
+        assert aiomodule.default_context(False) is aiomodule.global_context_threads
+        if aiomodule.libaio is not None:
+            assert aiomodule.default_context(True) is aiomodule.global_context_mt
+
 
 @pytest.mark.asyncio(loop_scope="class")
 class TestCases3: